@@ -0,0 +1,79 @@
+"""
+Measures cost of dispatching one chunk by Downloader scheduler depending on number of queued tasks.
+Dispatch (picking next task and re-queueing it) should take about the same time for 100 and 100k tasks.
+
+Usage: python -m benchmarks.bench_scheduler [--dispatches N] [--sizes 100,1000,10000,100000]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gc
+from random import Random
+from time import perf_counter
+
+from texport.download.downloader import Downloader, CHUNK_SIZE
+from texport.download.task_store import StoredTask
+
+CHATS = 50
+
+
+async def _noop_download(_task, _chunk_offset) -> None:
+    ...
+
+
+async def bench(queued: int, dispatches: int, seed: int = 0) -> float:
+    rnd = Random(seed)
+    downloader = Downloader(object(), 4, working_set=queued)
+    downloader._loop = asyncio.get_running_loop()
+    # Only scheduling is measured, chunks are not downloaded
+    downloader._download_task_wrapper = _noop_download
+
+    for task_id in range(1, queued + 1):
+        downloader._materialize(StoredTask(
+            task_id=task_id, file_id="", message_id=task_id, chat_id=rnd.randrange(CHATS), output_path="",
+            size=CHUNK_SIZE * rnd.randint(2, 10), is_thumb=False, chunk_size=CHUNK_SIZE,
+            high_priority=rnd.random() < 0.15, dc_id=2,
+        ))
+
+    # Same as timeit: collections of 100k live tasks would be measured instead of the scheduler otherwise
+    gc.collect()
+    gc.disable()
+    elapsed = 0.0
+    done = 0
+    try:
+        while done < dispatches:
+            start = perf_counter()
+            batch = 0
+            while batch < 1000 and (task := downloader._next_task()) is not None:
+                downloader._dispatch(task)
+                batch += 1
+            elapsed += perf_counter() - start
+            done += batch
+            if batch < 1000:
+                break
+
+            # Let created (no-op) download tasks finish outside of measured time
+            await asyncio.sleep(0)
+    finally:
+        gc.enable()
+
+    await asyncio.sleep(0)
+    return elapsed / max(done, 1)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark of downloader dispatch cost")
+    parser.add_argument("--dispatches", type=int, default=20000, help="Chunks dispatched per run")
+    parser.add_argument("--sizes", default="100,1000,10000,100000", help="Comma-separated numbers of queued tasks")
+    args = parser.parse_args()
+
+    print(f"{'queued tasks':>12} | {'us per dispatch':>15}")
+    for queued in map(int, args.sizes.split(",")):
+        per_dispatch = await bench(queued, args.dispatches)
+        print(f"{queued:>12} | {per_dispatch * 1e6:>15.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
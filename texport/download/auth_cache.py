@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import json
+import os
+from base64 import b64encode, b64decode
+from pathlib import Path
+
+
+class MediaAuthCache:
+    __slots__ = ("path", "_entries",)
+
+    def __init__(self, path: Path) -> None:
+        # Auth keys of non-home dcs with imported authorization, so next runs do not need to generate them again.
+        #  Key is only valid for account that authorized it, so user id is stored next to it.
+        self.path = path
+        self._entries: dict[str, dict] = {}
+
+        try:
+            with open(self.path, "r", encoding="utf8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if isinstance(entries, dict):
+            self._entries = entries
+
+    @staticmethod
+    def _key(dc_id: int, test_mode: bool) -> str:
+        return f"{'test' if test_mode else 'prod'}_{dc_id}"
+
+    def get(self, dc_id: int, test_mode: bool, user_id: int) -> bytes | None:
+        entry = self._entries.get(self._key(dc_id, test_mode))
+        if not isinstance(entry, dict) or entry.get("user_id") != user_id:
+            return None
+
+        try:
+            return b64decode(entry["auth_key"])
+        except (KeyError, ValueError):
+            return None
+
+    def set(self, dc_id: int, test_mode: bool, user_id: int, auth_key: bytes) -> None:
+        self._entries[self._key(dc_id, test_mode)] = {
+            "user_id": user_id,
+            "auth_key": b64encode(auth_key).decode("ascii"),
+        }
+        self._save()
+
+    def discard(self, dc_id: int, test_mode: bool) -> None:
+        if self._entries.pop(self._key(dc_id, test_mode), None) is not None:
+            self._save()
+
+    def _save(self) -> None:
+        # Auth keys give full access to account, so file is readable only by owner.
+        #  Written to temporary file first, so interrupted write does not corrupt existing keys.
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, "w", encoding="utf8") as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            ...
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+from asyncio import Event
+from collections import OrderedDict
+
+from pyrogram.raw.functions.upload import GetCdnFileHashes
+from pyrogram.raw.types import FileHash
+from pyrogram.session import Session
+
+
+class CdnHashCache:
+    def __init__(self, max_files: int = 256) -> None:
+        self._max_files = max_files
+        self._hashes: OrderedDict[bytes, dict[int, FileHash]] = OrderedDict()
+        self._pending: dict[tuple[bytes, int], Event] = {}
+
+    def add(self, file_token: bytes, hashes: list[FileHash]) -> None:
+        if file_token not in self._hashes:
+            self._hashes[file_token] = {}
+            while len(self._hashes) > self._max_files:
+                self._hashes.popitem(last=False)
+
+        self._hashes.move_to_end(file_token)
+        file_hashes = self._hashes[file_token]
+        for file_hash in hashes:
+            file_hashes[file_hash.offset] = file_hash
+
+    def _get_cached(self, file_token: bytes, offset: int) -> FileHash | None:
+        file_hashes = self._hashes.get(file_token)
+        if file_hashes is None:
+            return None
+        return file_hashes.get(offset)
+
+    async def _fetch(self, session: Session, file_token: bytes, offset: int) -> None:
+        key = (file_token, offset)
+        while (pending := self._pending.get(key)) is not None:
+            await pending.wait()
+            if self._get_cached(file_token, offset) is not None:
+                return
+
+        fetched = self._pending[key] = Event()
+        try:
+            self.add(file_token, await session.invoke(
+                GetCdnFileHashes(file_token=file_token, offset=offset), sleep_threshold=0,
+            ))
+        finally:
+            del self._pending[key]
+            fetched.set()
+
+    async def get(self, session: Session, file_token: bytes, offset: int, length: int) -> list[FileHash]:
+        result = []
+        end = offset + length
+
+        while offset < end:
+            file_hash = self._get_cached(file_token, offset)
+            if file_hash is None:
+                await self._fetch(session, file_token, offset)
+                file_hash = self._get_cached(file_token, offset)
+            if file_hash is None or file_hash.limit <= 0:
+                raise ValueError(f"Server did not return cdn file hash for offset {offset}")
+
+            result.append(file_hash)
+            offset = file_hash.offset + file_hash.limit
+
+        return result
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import os
+from threading import Lock
+from asyncio import Future
+from pathlib import Path
+
+from .manifest import ChunkManifest
+
+_HAS_PWRITE = hasattr(os, "pwrite")
+_HAS_PWRITEV = hasattr(os, "pwritev")
+
+
+class ChunkFile:
+    __slots__ = ("fd", "manifest", "pending", "flushing", "_seek_lock",)
+
+    def __init__(self, path: Path, manifest: ChunkManifest | None, truncate: bool) -> None:
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        if truncate:
+            flags |= os.O_TRUNC
+
+        self.fd = os.open(path, flags, 0o644)
+        self.manifest = manifest
+        # Chunks waiting to be written when write coalescing is enabled
+        self.pending: list[tuple[int, bytes, Future]] = []
+        self.flushing = False
+        # Positional writes are not available on Windows, so seek + write pairs are serialized there
+        self._seek_lock = None if _HAS_PWRITE else Lock()
+
+    def preallocate(self, size: int) -> None:
+        os.ftruncate(self.fd, size)
+
+    def _write_at(self, offset: int, data: bytes | memoryview) -> None:
+        data = memoryview(data)
+        while data:
+            if self._seek_lock is None:
+                written = os.pwrite(self.fd, data, offset)
+            else:
+                with self._seek_lock:
+                    os.lseek(self.fd, offset, os.SEEK_SET)
+                    written = os.write(self.fd, data)
+            data = data[written:]
+            offset += written
+
+    def write(self, offset: int, chunks: list[bytes]) -> None:
+        if len(chunks) > 1 and _HAS_PWRITEV:
+            total = sum(len(chunk) for chunk in chunks)
+            written = os.pwritev(self.fd, chunks, offset)
+            if written < total:
+                self._write_at(offset + written, memoryview(b"".join(chunks))[written:])
+        else:
+            chunk_offset = offset
+            for chunk in chunks:
+                self._write_at(chunk_offset, chunk)
+                chunk_offset += len(chunk)
+
+        if self.manifest is not None:
+            for chunk in chunks:
+                self.manifest.add(offset)
+                offset += len(chunk)
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.manifest is not None:
+            self.manifest.close()
+
+    def finish(self) -> None:
+        self.close()
+        if self.manifest is not None:
+            self.manifest.remove()
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+from asyncio import Future, CancelledError, Event, Lock, get_running_loop, wait_for
+from collections import deque
+from time import time, monotonic
+
+
+class AdaptiveLimiter:
+    def __init__(self, limit: int, min_limit: int = 1, max_limit: int | None = None, history_size: int = 16) -> None:
+        self._min_limit = max(min_limit, 1)
+        self._max_limit = max(max_limit if max_limit is not None else limit, self._min_limit)
+        self._limit = float(min(max(limit, self._min_limit), self._max_limit))
+
+        self._in_flight = 0
+        self._waiters: deque[Future] = deque()
+
+        # Request size -> latency. Request of 4KB and of 1MB take very different time, so latency of each request
+        #  is compared only with latency of requests of same size.
+        self._latency: dict[int, float] = {}
+        self._base_latency: dict[int, float] = {}
+        self._error_rate = 0.0
+        self._last_decrease = 0.0
+
+        self.history: deque[int] = deque([self.limit], maxlen=history_size)
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _set_limit(self, limit: float) -> None:
+        old_limit = self.limit
+        self._limit = min(max(limit, self._min_limit), self._max_limit)
+        if self.limit != old_limit:
+            self.history.append(self.limit)
+            self._wake()
+
+    def _wake(self) -> None:
+        free = self.limit - self._in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    async def acquire(self) -> None:
+        while self._in_flight >= self.limit:
+            waiter = get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except CancelledError:
+                # Wakeup was already given to this waiter, pass it to next one
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()
+                raise
+
+        self._in_flight += 1
+
+    def release(self) -> None:
+        self._in_flight -= 1
+        self._wake()
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.release()
+
+    def on_success(self, latency: float, size: int = 0) -> None:
+        self._error_rate *= 0.9
+        avg_latency = self._latency.get(size)
+        avg_latency = self._latency[size] = latency if avg_latency is None else avg_latency * 0.8 + latency * 0.2
+        base_latency = self._base_latency[size] = min(self._base_latency.get(size, avg_latency), avg_latency)
+
+        # Additive increase: limit grows by ~1 after "limit" successful requests while latency and errors are fine
+        if avg_latency <= base_latency * 2 and self._error_rate < 0.1:
+            self._set_limit(self._limit + 1 / self._limit)
+
+    def on_error(self) -> None:
+        self._error_rate = self._error_rate * 0.9 + 0.1
+
+    def on_congestion(self) -> None:
+        self.on_error()
+
+        # Multiplicative decrease, but at most once per request round trip so burst of errors caused
+        #  by same overload does not drop limit to minimum
+        now = time()
+        if (now - self._last_decrease) > max([*self._latency.values(), 1]):
+            self._last_decrease = now
+            self._set_limit(self._limit / 2)
+
+
+class ByteBudget:
+    def __init__(self, limit: int) -> None:
+        self._limit = limit
+        self._released = Event()
+
+        self.used = 0
+        self.high_water = 0
+
+    async def acquire(self, size: int) -> None:
+        # Request bigger than whole budget is allowed when nothing else is using it, so it does not block forever
+        while self.used and self.used + size > self._limit:
+            self._released.clear()
+            await self._released.wait()
+
+        self.used += size
+        self.high_water = max(self.high_water, self.used)
+
+    def release(self, size: int) -> None:
+        self.used -= size
+        self._released.set()
+
+
+class TokenBucket:
+    def __init__(self, rate: int = 0) -> None:
+        # Rate is in bytes per second, 0 means unlimited. Bucket holds at most one second worth of tokens.
+        #  Requests bigger than bucket are allowed and leave it in debt, next requests wait until debt is repaid.
+        self._rate = max(rate, 0)
+        self._tokens = float(self._rate)
+        self._updated = monotonic()
+        self._lock = Lock()
+        self._changed = Event()
+
+        self.throttled_time = 0.0
+
+    @property
+    def rate(self) -> int:
+        return self._rate
+
+    def set_rate(self, rate: int) -> None:
+        self._refill()
+        self._rate = max(rate, 0)
+        self._tokens = min(self._tokens, self._rate) if self._rate else 0.0
+        self._changed.set()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        if self._rate:
+            self._tokens = min(self._tokens + (now - self._updated) * self._rate, self._rate)
+        self._updated = now
+
+    async def consume(self, amount: int) -> None:
+        if not self._rate:
+            return
+
+        # Only one request waits for tokens at a time, so requests are served in order and big ones are not starved
+        async with self._lock:
+            self._refill()
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return
+
+            start = monotonic()
+            while self._rate and self._tokens < 0:
+                self._changed.clear()
+                try:
+                    await wait_for(self._changed.wait(), -self._tokens / self._rate)
+                except TimeoutError:
+                    ...
+                self._refill()
+            self.throttled_time += monotonic() - start
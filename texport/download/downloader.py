@@ -1,43 +1,83 @@
 from __future__ import annotations
 
 import asyncio
-import bisect
-from asyncio import Task, sleep, Lock, get_running_loop, Event, Semaphore
+from asyncio import Task, sleep, Lock, get_running_loop, Event, Future, Semaphore
 from collections import defaultdict
 from concurrent.futures.thread import ThreadPoolExecutor
 from hashlib import sha256
+from heapq import heappush, heappop
 from pathlib import Path
 from time import time
-from typing import BinaryIO
+from typing import Callable
+from weakref import WeakValueDictionary
 
 from pyrogram import Client
 from pyrogram.crypto import aes
 from pyrogram.errors import FileReferenceInvalid, FileReferenceExpired, AuthBytesInvalid, VolumeLocNotFound, \
-    CDNFileHashMismatch, AuthKeyUnregistered
-from pyrogram.file_id import FileId, FileType, ThumbnailSource, FileIdCached
+    CDNFileHashMismatch, AuthKeyUnregistered, FloodWait
+from pyrogram.file_id import FileId, FileType, ThumbnailSource, FileIdCached, PHOTO_TYPES
 from pyrogram.raw.functions.auth import ExportAuthorization, ImportAuthorization
-from pyrogram.raw.functions.upload import GetFile, GetCdnFile, ReuploadCdnFile, GetCdnFileHashes
+from pyrogram.raw.functions.upload import GetFile, GetCdnFile, ReuploadCdnFile
+from pyrogram.raw.functions.users import GetUsers
 from pyrogram.raw.types import InputPeerUser, InputPeerChat, InputPeerChannel, \
-    InputPeerPhotoFileLocation, InputPhotoFileLocation, InputDocumentFileLocation
+    InputPeerPhotoFileLocation, InputPhotoFileLocation, InputDocumentFileLocation, FileHash, InputUserSelf
 from pyrogram.raw.types.upload import File, FileCdnRedirect, CdnFileReuploadNeeded
 from pyrogram.session import Session, Auth
 from pyrogram.utils import get_channel_id
 
-from texport.media import MEDIA_TYPES
-
-# Whole downloader will break if chunk_size inside pyrogram's get_file changes
+from texport.media import MEDIA_TYPES, ExpiredMedia
+from .auth_cache import MediaAuthCache
+from .cdn_hashes import CdnHashCache
+from .concurrency import AdaptiveLimiter, ByteBudget, TokenBucket
+from .retry import RetryPolicy, CircuitBreaker, FailedDownload
+from .chunk_file import ChunkFile
+from .manifest import ChunkManifest
+from .scheduler import ReadyQueue, FairReadyQueue
+from .session_pool import SessionPool, FloodWaitClient
+from .task_store import TaskStore, StoredTask
+
+# Maximum (and default) chunk size allowed by upload.getFile
 CHUNK_SIZE = 1024 * 1024
+MIN_CHUNK_SIZE = 4 * 1024
+# Cdn file hashes are calculated over parts of this size, so cdn requests can not be smaller
+CDN_HASH_PART_SIZE = 128 * 1024
+
+
+def get_media_key(file_id: str | FileId) -> str:
+    file_id_obj = FileId.decode(file_id) if isinstance(file_id, str) else file_id
+
+    # Photo and document ids are different id spaces, sizes of one photo/document share media id
+    kind = "photo" if file_id_obj.file_type in PHOTO_TYPES else "document"
+    return f"{kind}_{file_id_obj.media_id}_{file_id_obj.thumbnail_size or ''}"
+
+
+def normalize_chunk_size(chunk_size: int) -> int:
+    # https://core.telegram.org/api/files#downloading-files: limit must be divisible by 4096 and 1MB must be
+    #  divisible by limit, so only powers of two between 4KB and 1MB are allowed
+    result = MIN_CHUNK_SIZE
+    while result < min(chunk_size, CHUNK_SIZE):
+        result *= 2
+    return result
+
+
+def get_request_limit(offset: int, size: int, chunk_size: int) -> int:
+    # Smallest allowed limit that covers rest of the file (or whole chunk). Offsets are always multiples of
+    #  chunk_size, so request never crosses 1MB boundary.
+    if size <= 0:
+        return chunk_size
+    return min(normalize_chunk_size(size - offset), chunk_size)
 
 
 class DownloadTask:
     __slots__ = (
-        "file_id", "message_id", "output_path", "high_priority", "size", "is_thumb", "offset", "lock", "file",
-        "active_tasks", "failed_chunks", "done", "wrote_bytes", "task_id", "need_fileref_renew", "_downloader",
+        "file_id", "message_id", "chat_id", "output_path", "high_priority", "size", "is_thumb", "offset", "lock", "file",
+        "active_tasks", "failed_chunks", "done", "wrote_bytes", "task_id", "need_fileref_renew", "queue", "queue_gen",
+        "done_chunks", "chunk_size", "dc_id", "errors", "error", "retry_at", "delayed", "retry_chunks",
     )
 
     def __init__(
             self, file_id: str, message_id: int, output_path: Path, high_priority: bool, size: int, is_thumb: bool,
-            *, task_id: int, downloader: Downloader,
+            *, task_id: int, chat_id: int = 0, chunk_size: int = CHUNK_SIZE, dc_id: int = 0,
     ) -> None:
         self.task_id = task_id
         # For testing file references renewing
@@ -47,416 +87,952 @@ class DownloadTask:
         #    file_id = _id.encode()
         self.file_id = file_id
         self.message_id = message_id
+        self.chat_id = chat_id
+        self.dc_id = dc_id
         self.output_path = output_path
         self.high_priority = high_priority
         self.size = size
         self.is_thumb = is_thumb
+        self.chunk_size = normalize_chunk_size(chunk_size)
         self.wrote_bytes = 0
         self.offset = 0
         self.lock = Lock()
-        self.file: BinaryIO | None = None
+        self.file: ChunkFile | None = None
+        # Offsets of chunks that are already on disk, None until file is opened
+        self.done_chunks: set[int] | None = None
         self.active_tasks = 0
         self.failed_chunks: set[int] = set()
+        # Offsets of chunks that failed with error -> time before which they should not be requested again,
+        #  other chunks of file keep downloading meanwhile
+        self.retry_chunks: dict[int, float] = {}
         self.done = Event()
+        # Failed requests so far, last error when error budget is exhausted, and time before which
+        #  task should not be dispatched again (backoff or paused dc)
+        self.errors = 0
+        self.error: str | None = None
+        self.retry_at = 0.0
+        self.delayed = False
 
         self.need_fileref_renew = False
-        self._downloader = downloader
-
-    def set_priority_high(self, is_high: bool) -> None:
-        if is_high == self.high_priority:
-            return
-        self._downloader.set_task_priority_high(self, is_high)
+        self.queue: ReadyQueue | None = None
+        self.queue_gen = 0
+
+    def missing_chunks(self) -> set[int]:
+        # Every chunk of file must be either found on disk when file was opened or written since then,
+        #  otherwise preallocated file would silently contain zeroes instead of them
+        if self.done_chunks is None:
+            return set()
+        return set(range(0, max(self.size, 1), self.chunk_size)) - self.done_chunks
+
+    def _skip_done_chunks(self) -> None:
+        if self.done_chunks:
+            while self.offset in self.done_chunks:
+                self.offset += self.chunk_size
+
+    def _due_retry_chunk(self) -> int | None:
+        if not self.retry_chunks:
+            return None
+        offset = min(self.retry_chunks, key=self.retry_chunks.__getitem__)
+        return offset if self.retry_chunks[offset] <= time() else None
+
+    def next_retry_at(self) -> float:
+        return min(self.retry_chunks.values(), default=0.0)
+
+    def has_chunks(self) -> bool:
+        # Whether task has chunk that can be requested right now
+        if self.error is not None:
+            return False
+        self._skip_done_chunks()
+        # Offset 0 is always dispatched at least once, so empty files are created too
+        return bool(self.failed_chunks) or self._due_retry_chunk() is not None \
+            or self.offset < self.size or self.offset == 0
+
+    def next_chunk(self) -> int:
+        if self.failed_chunks:
+            return self.failed_chunks.pop()
+        if (offset := self._due_retry_chunk()) is not None:
+            del self.retry_chunks[offset]
+            return offset
+
+        self._skip_done_chunks()
+
+        chunk_offset, self.offset = self.offset, self.offset + self.chunk_size
+        return chunk_offset
+
+    @property
+    def is_small(self) -> bool:
+        return self.is_thumb or self.size <= self.chunk_size
 
     def __lt__(self, other: DownloadTask) -> bool:
         return self.task_id < other.task_id
 
 
+class DownloadHandle:
+    __slots__ = ("task_id", "output_path", "size", "done", "error", "_downloader", "__weakref__",)
+
+    def __init__(self, task_id: int, output_path: Path, size: int, downloader: Downloader) -> None:
+        # What is returned to callers of add_task. DownloadTask itself exists only while task is in working set.
+        self.task_id = task_id
+        self.output_path = output_path
+        self.size = size
+        self.done = Event()
+        # Set when file could not be downloaded, done is set in this case too
+        self.error: str | None = None
+        self._downloader = downloader
+
+    def set_priority_high(self, is_high: bool) -> None:
+        self._downloader.set_task_priority_high(self.task_id, is_high)
+
+
 class Downloader:
-    def __init__(self, client: Client, max_concurrent_downloads: int) -> None:
+    def __init__(
+            self, client: Client, max_concurrent_downloads: int, media_sessions_per_dc: int = 1,
+            progress_callback: Callable[[], None] | None = None, max_adaptive_downloads: int | None = None,
+            coalesce_writes: bool = False, memory_limit: int = 64 * 1024 * 1024, queue_path: Path | None = None,
+            working_set: int = 1000, auth_cache_path: Path | None = None, bandwidth_limit: int = 0,
+            dc_bandwidth_limits: dict[int, int] | None = None, retry_policy: RetryPolicy | None = None,
+            task_done_callback: Callable[[DownloadTask], None] | None = None,
+    ) -> None:
         self._client = client
-        self._max_concurrent_tasks = max_concurrent_downloads + 1
+        # Media and cdn sessions raise every FloodWait, so it is handled in _get_file
+        self._session_client = FloodWaitClient(client)
 
         self._running = False
         self._loop_task: Task | None = None
 
-        self._tasks_lo: list[DownloadTask] = []
-        self._tasks_hi: list[DownloadTask] = []
+        self._tasks_lo = FairReadyQueue()
+        self._tasks_hi = FairReadyQueue()
+        # Thumbnails and files that fit into one chunk, shortest first. Lane has its own share of download slots,
+        #  so they are not stuck behind big files (and big files are not starved by them).
+        self._tasks_small = ReadyQueue(lambda t: (not t.high_priority, t.size, t.task_id))
+        self._running_small = 0
+        self._running_large = 0
+        # Pending tasks are kept in task store, only up to "working_set" of them are materialized at once
+        self._store = TaskStore(queue_path)
+        self._working_set = max(working_set, 1)
+        self._active: dict[int, DownloadTask] = {}
+        self._handles: WeakValueDictionary[int, DownloadHandle] = WeakValueDictionary()
+        self._tasks_count = 0
         self._running_tasks: set[Task] = set()
+        # Tasks waiting for backoff to pass or for their dc to be resumed, (retry_at, task_id, task)
+        self._delayed: list[tuple[float, int, DownloadTask]] = []
+        self._retry = retry_policy or RetryPolicy()
+        self._breakers: dict[int, CircuitBreaker] = defaultdict(CircuitBreaker)
+        # Dc id -> time before which no chunks are requested from dc, because it answered with FloodWait
+        self._flood_until: dict[int, float] = {}
+        self.failures: list[FailedDownload] = []
+        self.failed_bytes = 0
 
         self._renewing_tasks: set[DownloadTask] = set()
         self._need_renew_tasks: set[DownloadTask] = set()
         self._last_renew_time = 0
         self._renew_task: Task | None = None
+        # Media key -> latest renewed file id
+        self._renewed_file_ids: dict[str, str] = {}
 
         self._loop = get_running_loop()
-        self._write_executor = ThreadPoolExecutor(max_concurrent_downloads, thread_name_prefix="FileWrite")
-        self._getfile_sem = Semaphore(max_concurrent_downloads)
-
-        self._id_seq = 0
+        # When max_adaptive_downloads is set, concurrency starts at max_concurrent_downloads and is
+        #  adjusted between 1 and max_adaptive_downloads depending on latency and flood waits
+        self._concurrency = AdaptiveLimiter(
+            max_concurrent_downloads,
+            1 if max_adaptive_downloads else max_concurrent_downloads,
+            max_adaptive_downloads or max_concurrent_downloads,
+        )
+        self._write_executor = ThreadPoolExecutor(
+            max(max_concurrent_downloads, max_adaptive_downloads or 0), thread_name_prefix="FileWrite",
+        )
+        self._coalesce_writes = coalesce_writes
+        # Limits bytes of chunks that are requested or downloaded but not written to disk yet
+        self._memory = ByteBudget(memory_limit)
+        # Bytes per second, for all downloads and for downloads from specific dcs
+        self._bandwidth = TokenBucket(bandwidth_limit)
+        self._dc_bandwidth: dict[int, TokenBucket] = {
+            dc_id: TokenBucket(limit) for dc_id, limit in (dc_bandwidth_limits or {}).items()
+        }
+        self._media_sessions = SessionPool(
+            self._create_media_session, media_sessions_per_dc, keep_alive=self._dc_has_work,
+        )
+        # Dc id -> number of materialized tasks
+        self._active_dcs: dict[int, int] = defaultdict(int)
+        self._warmup_tasks: set[Task] = set()
+        self._media_auth_keys: dict[int, bytes] = {}
+        self._media_auth_locks: dict[int, Lock] = defaultdict(Lock)
+        self._auth_cache = MediaAuthCache(auth_cache_path) if auth_cache_path is not None else None
+        self._cdn_sessions = SessionPool(self._create_cdn_session, max_concurrent_downloads)
+        self._cdn_hashes = CdnHashCache()
+        self._hash_executor = ThreadPoolExecutor(2, thread_name_prefix="CdnHash")
 
         self._tasks_changed = Event()
 
         self.bytes_downloaded = 0
+        self._progress_callback = progress_callback
+        self._task_done_callback = task_done_callback
+
+    @property
+    def queue_size(self) -> int:
+        return self._tasks_count + self._store.pending
+
+    @property
+    def total_bytes(self) -> int:
+        return self._store.total_bytes
+
+    @property
+    def done_bytes(self) -> int:
+        return self._store.done_bytes
+
+    def media_sessions_load(self) -> dict[int, list[int]]:
+        return self._media_sessions.loads()
+
+    @property
+    def concurrency_limit(self) -> int:
+        return self._concurrency.limit
+
+    @property
+    def concurrency_history(self) -> list[int]:
+        return list(self._concurrency.history)
+
+    def paused_dcs(self) -> list[int]:
+        return sorted(dc_id for dc_id, breaker in self._breakers.items() if breaker.is_open)
+
+    @property
+    def bandwidth_limit(self) -> int:
+        return self._bandwidth.rate
+
+    @property
+    def throttled_time(self) -> float:
+        return self._bandwidth.throttled_time + sum(bucket.throttled_time for bucket in self._dc_bandwidth.values())
+
+    def set_bandwidth_limit(self, limit: int, dc_id: int | None = None) -> None:
+        if dc_id is None:
+            self._bandwidth.set_rate(limit)
+        elif dc_id in self._dc_bandwidth:
+            self._dc_bandwidth[dc_id].set_rate(limit)
+        else:
+            self._dc_bandwidth[dc_id] = TokenBucket(limit)
+
+    @property
+    def buffered_bytes(self) -> int:
+        return self._memory.used
+
+    @property
+    def buffered_bytes_peak(self) -> int:
+        return self._memory.high_water
 
     def add_task(
-            self, file_id: str, message_id: int, output_path: Path, high_priority: bool, size: int, is_thumb: bool
-    ) -> DownloadTask:
-        self._id_seq += 1
+            self, file_id: str, message_id: int, output_path: Path, high_priority: bool, size: int, is_thumb: bool,
+            chat_id: int = 0, chunk_size: int = CHUNK_SIZE,
+    ) -> DownloadHandle:
+        file_id_obj = FileId.decode(file_id)
+        dc_id = file_id_obj.dc_id
+        new_dc = not self._store.has_pending_dc(dc_id) and not self._active_dcs.get(dc_id)
+
+        added = self._store.add(
+            get_media_key(file_id_obj), file_id, message_id, chat_id, output_path, size, is_thumb, chunk_size,
+            high_priority, dc_id,
+        )
+        if added.created and new_dc:
+            self._warm_up(dc_id)
+
+        handle = self._handles.get(added.task_id)
+        if handle is None:
+            handle = self._handles[added.task_id] = DownloadHandle(
+                added.task_id, Path(added.output_path), added.size, self,
+            )
+            if added.done:
+                # Task may have finished (or failed) after previous handle for it was garbage collected
+                handle.error = added.error
+                handle.done.set()
+
+        if added.created:
+            self._tasks_changed.set()
+            if self._progress_callback is not None:
+                self._progress_callback()
+
+        return handle
+
+    def _materialize(self, stored: StoredTask) -> None:
         task = DownloadTask(
-            file_id, message_id, output_path, high_priority, size, is_thumb, task_id=self._id_seq, downloader=self,
+            stored.file_id, stored.message_id, Path(stored.output_path), bool(stored.high_priority), stored.size,
+            bool(stored.is_thumb), task_id=stored.task_id, chat_id=stored.chat_id, chunk_size=stored.chunk_size,
+            dc_id=stored.dc_id,
         )
-        bisect.insort_left(self._tasks_hi if high_priority else self._tasks_lo, task)
+        self._active[task.task_id] = task
+        self._active_dcs[task.dc_id] += 1
+        self._tasks_count += 1
+        self._task_changed(task)
+
+    def _fill_working_set(self) -> None:
+        # Refill in batches, not one task at a time, so store is not queried after every finished task
+        if self._store.pending and self._tasks_count <= self._working_set // 2:
+            for stored in self._store.take(self._working_set - self._tasks_count):
+                self._materialize(stored)
+
+    def _dc_has_work(self, dc_id: int) -> bool:
+        return self._active_dcs.get(dc_id, 0) > 0 or self._store.has_pending_dc(dc_id)
+
+    def _warm_up(self, dc_id: int) -> None:
+        # Dc of every file is known from its file id, so session (and authorization for non-home dcs)
+        #  is prepared in background as soon as first task for dc is queued, not when its first chunk is requested
+        task = self._loop.create_task(self._warm_up_session(dc_id))
+        self._warmup_tasks.add(task)
+        task.add_done_callback(self._warmup_tasks.discard)
+
+    async def _warm_up_session(self, dc_id: int) -> None:
+        try:
+            await self._media_sessions.warm_up(dc_id)
+        except Exception:
+            # Session creation will be retried (and error will be raised) on first request to this dc
+            ...
+
+    def has_task(self, file_id: str) -> bool:
+        # Whether same media was already added (in this run or previous one)
+        return self._store.has(get_media_key(file_id))
+
+    def set_chat_weight(self, chat_id: int, weight: int) -> None:
+        self._tasks_lo.set_weight(chat_id, weight)
+        self._tasks_hi.set_weight(chat_id, weight)
+
+    def set_task_priority_high(self, task_id: int, to_high: bool) -> None:
+        task = self._active.get(task_id)
+        if task is None:
+            # Task that somebody waits for is loaded right away instead of waiting for its turn in the store
+            if to_high and (stored := self._store.take_one(task_id)) is not None:
+                self._materialize(stored)
+                task = self._active[task_id]
+            else:
+                self._store.set_high_priority(task_id, to_high)
+                return
+
+        if to_high == task.high_priority:
+            return
+        task.high_priority = to_high
+        if task.queue is None:
+            return
+
+        task.queue.discard(task)
+        self._queue_for(task).push(task)
         self._tasks_changed.set()
-        return task
 
-    def set_task_priority_high(self, task: DownloadTask, to_high: bool) -> None:
-        old_queue = self._tasks_lo if to_high else self._tasks_hi
-        new_queue = self._tasks_hi if to_high else self._tasks_lo
+    def _queue_for(self, task: DownloadTask) -> ReadyQueue | FairReadyQueue:
+        if task.is_small:
+            return self._tasks_small
+        return self._tasks_hi if task.high_priority else self._tasks_lo
 
-        task_idx = bisect.bisect_left(old_queue, task)
-        if task_idx >= len(old_queue) or task_idx < 0 or old_queue[task_idx] is not task:
+    def _task_changed(self, task: DownloadTask) -> None:
+        if task.done.is_set():
             return
 
-        del old_queue[task_idx]
+        if task.need_fileref_renew:
+            # Same media may have already been renewed for other chunk or task, no need to request it again
+            renewed_file_id = self._renewed_file_ids.get(get_media_key(task.file_id))
+            if renewed_file_id is not None and renewed_file_id != task.file_id:
+                task.file_id = renewed_file_id
+                task.need_fileref_renew = False
 
-        task.high_priority = to_high
-        bisect.insort_left(new_queue, task)
+        if task.need_fileref_renew:
+            if task.queue is not None:
+                task.queue.discard(task)
+            if task not in self._renewing_tasks and task not in self._need_renew_tasks:
+                if not self._need_renew_tasks:
+                    self._last_renew_time = time()
+                self._need_renew_tasks.add(task)
+        elif task.has_chunks():
+            if task.queue is None and not task.delayed:
+                if task.retry_at > time():
+                    self._delay(task)
+                else:
+                    self._queue_for(task).push(task)
+        elif task.retry_chunks and task.error is None:
+            # Only chunks that are backing off are left, task waits for the first of them
+            if not task.delayed:
+                task.retry_at = max(task.retry_at, task.next_retry_at())
+                self._delay(task)
+        elif not task.active_tasks and task.error is None and (missing := task.missing_chunks()):
+            task.failed_chunks.update(missing)
+            self._queue_for(task).push(task)
+        elif not task.active_tasks:
+            self._tasks_count -= 1
+            task.done.set()
+            self._active.pop(task.task_id, None)
+            self._active_dcs[task.dc_id] -= 1
+            handle = self._handles.get(task.task_id)
+
+            if task.error is None:
+                if task.file is not None:
+                    task.file.finish()
+                self._store.finish(task.task_id, task.size)
+            else:
+                # Manifest is kept, so next run continues from already downloaded chunks
+                if task.file is not None:
+                    task.file.close()
+                self._store.fail(task.task_id, task.error)
+                self.failed_bytes += task.size
+                self.failures.append(FailedDownload(
+                    task.message_id, task.chat_id, str(task.output_path), task.size, task.error,
+                ))
+                if handle is not None:
+                    handle.error = task.error
+
+            if handle is not None:
+                handle.done.set()
+            if self._task_done_callback is not None:
+                self._task_done_callback(task)
+
+        self._tasks_changed.set()
+        if self._progress_callback is not None:
+            self._progress_callback()
+
+    def _delay(self, task: DownloadTask) -> None:
+        if task.queue is not None:
+            task.queue.discard(task)
+        task.delayed = True
+        heappush(self._delayed, (task.retry_at, task.task_id, task))
+
+    def _wake_delayed(self) -> float | None:
+        now = time()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, task = heappop(self._delayed)
+            task.delayed = False
+            self._task_changed(task)
+
+        # Seconds until next delayed task can be dispatched
+        return (self._delayed[0][0] - now) if self._delayed else None
+
+    def _on_task_error(self, task: DownloadTask, chunk_offset: int, error: Exception) -> None:
+        task.errors += 1
+        if task.errors >= self._retry.error_budget:
+            # Error budget is exhausted, file is reported as failed instead of being retried forever
+            task.error = f"{type(error).__name__}: {error}"
+            task.failed_chunks.clear()
+            task.retry_chunks.clear()
+            task.offset = task.size + 1
+        else:
+            # Only failed chunk backs off, so it is not re-dispatched right away while task stays in its queue
+            task.retry_chunks[chunk_offset] = time() + self._retry.delay(task.errors)
+
+    def _next_task(self) -> DownloadTask | None:
+        small = self._tasks_small.peek()
+        large = self._tasks_hi.peek()
+        if large is None:
+            large = self._tasks_lo.peek()
+
+        # When both lanes have tasks, each of them can take all slots except "share" ones
+        limit = self._concurrency.limit
+        lane_limit = max(limit - max(limit // 4, 1), 1)
+        if small is not None and (large is None or self._running_small < lane_limit):
+            return small
+        if large is not None and (small is None or self._running_large < lane_limit):
+            return large
+
+        return None
+
+    def _dispatch(self, task: DownloadTask) -> None:
+        chunk_offset = task.next_chunk()
+        task.active_tasks += 1
+        if not task.has_chunks():
+            task.queue.discard(task)
+        self._queue_for(task).rotate()
+
+        if task.is_small:
+            self._running_small += 1
+        else:
+            self._running_large += 1
+
+        new_task = self._loop.create_task(self._download_task_wrapper(task, chunk_offset))
+        self._running_tasks.add(new_task)
+        new_task.add_done_callback(self._running_task_done)
+
+    def _running_task_done(self, task: Task) -> None:
+        self._running_tasks.discard(task)
         self._tasks_changed.set()
 
+    def _maybe_renew_filerefs(self) -> None:
+        if self._need_renew_tasks \
+                and ((time() - self._last_renew_time) > 5 or len(self._need_renew_tasks) >= 100) \
+                and self._renew_task is None:
+            self._renew_task = self._loop.create_task(self._renew_filerefs())
+            self._renew_task.add_done_callback(lambda _: setattr(self, "_renew_task", None))
+            self._last_renew_time = time()
+
     async def _renew_filerefs(self) -> None:
-        to_renew_ids: dict[int, list[DownloadTask]] = defaultdict(list)
+        # Chat id -> message id -> tasks
+        to_renew: dict[int, dict[int, list[DownloadTask]]] = defaultdict(lambda: defaultdict(list))
 
-        while self._need_renew_tasks and len(to_renew_ids) < 100:
+        while self._need_renew_tasks:
             task = self._need_renew_tasks.pop()
             self._renewing_tasks.add(task)
-            to_renew_ids[task.message_id].append(task)
+            to_renew[task.chat_id][task.message_id].append(task)
 
-        if not to_renew_ids:
-            return
+        batches = []
+        for chat_id, by_message in to_renew.items():
+            message_ids = list(by_message.keys())
+            for i in range(0, len(message_ids), 100):
+                batch = {message_id: by_message[message_id] for message_id in message_ids[i:i + 100]}
+                batches.append((chat_id, batch))
+
+        sem = Semaphore(4)
+        await asyncio.gather(*(self._renew_filerefs_batch(sem, chat_id, batch) for chat_id, batch in batches))
 
-        # TODO: pass channel/supergroup id
-        for message in await self._client.get_messages(message_ids=list(to_renew_ids.keys()), replies=0):
-            if message.id not in to_renew_ids:
+        # Tasks from failed batches are retried on next renew
+        self._need_renew_tasks.update(self._renewing_tasks)
+        self._renewing_tasks.clear()
+        self._tasks_changed.set()
+
+    async def _renew_filerefs_batch(
+            self, sem: Semaphore, chat_id: int, to_renew: dict[int, list[DownloadTask]],
+    ) -> None:
+        async with sem:
+            while True:
+                try:
+                    messages = await self._client.get_messages(
+                        chat_id=chat_id or None, message_ids=list(to_renew.keys()), replies=0,
+                    )
+                except FloodWait as e:
+                    await sleep(e.value)
+                except Exception as e:
+                    # E.g. chat became private, tasks are renewed again later until their error budget is exhausted
+                    for tasks in to_renew.values():
+                        for task in tasks:
+                            self._on_renew_error(task, f"{type(e).__name__}: {e}")
+                    return
+                else:
+                    break
+
+        for message in messages:
+            if message.id not in to_renew:
                 continue
 
-            m = MEDIA_TYPES[message.media]
-            media, thumb = m.get_media(message)
+            media = thumb = None
+            if not message.empty and message.media in MEDIA_TYPES:
+                media, thumb = MEDIA_TYPES[message.media].get_media(message)
 
-            for task in to_renew_ids[message.id]:
+            for task in to_renew.pop(message.id):
                 obj = media
                 if task.is_thumb:
                     obj = thumb
-                if obj is None:
-                    task.offset = task.size + 1
-                    task.wrote_bytes = task.size
+                if obj is None or isinstance(obj, ExpiredMedia):
+                    # Message was deleted or media is not available anymore, there is nothing to download
+                    task.error = "Media is not available anymore"
+                    task.failed_chunks.clear()
+                    task.retry_chunks.clear()
                 else:
                     task.file_id = obj.file_id
+                    self._renewed_file_ids[get_media_key(task.file_id)] = task.file_id
+                    self._store.set_file_id(task.task_id, task.file_id)
                 task.need_fileref_renew = False
                 self._renewing_tasks.discard(task)
+                self._task_changed(task)
 
-        self._need_renew_tasks.update(self._renewing_tasks)
-        self._renewing_tasks.clear()
+        for tasks in to_renew.values():
+            for task in tasks:
+                self._on_renew_error(task, "Message was not returned when renewing file reference")
 
-    async def _get_media_session(self, dc_id: int) -> Session:
-        session = self._client.media_sessions.get(dc_id)
-        if session:
-            return session
+    def _on_renew_error(self, task: DownloadTask, error: str) -> None:
+        # Task stays in renewing set and is renewed again on next renew, unless its error budget is exhausted
+        task.errors += 1
+        if task.errors < self._retry.error_budget:
+            return
 
+        task.error = error
+        task.failed_chunks.clear()
+        task.retry_chunks.clear()
+        task.offset = task.size + 1
+        task.need_fileref_renew = False
+        self._renewing_tasks.discard(task)
+        self._task_changed(task)
+
+    async def _import_authorization(self, session: Session, dc_id: int) -> None:
+        attempts = 0
+        while True:
+            try:
+                exported_auth = await self._client.invoke(ExportAuthorization(dc_id=dc_id))
+                await session.invoke(
+                    ImportAuthorization(
+                        id=exported_auth.id,
+                        bytes=exported_auth.bytes
+                    ),
+                    sleep_threshold=0,
+                )
+                return
+            except FloodWait as e:
+                # Not a failed attempt, authorization is imported when flood wait is over
+                await sleep(e.value)
+            except AuthBytesInvalid:
+                attempts += 1
+                if attempts >= 3:
+                    raise
+
+    async def _create_media_session(self, dc_id: int) -> Session:
         storage = self._client.storage
+        test_mode = await storage.test_mode()
+
+        # All sessions to one dc share auth key, so key generation and authorization import are done only once.
+        #  Lock is held only while key is created, other sessions to same dc are started in parallel.
+        if dc_id == await storage.dc_id():
+            auth_key = await storage.auth_key()
+        elif (auth_key := self._media_auth_keys.get(dc_id)) is None:
+            async with self._media_auth_locks[dc_id]:
+                if (auth_key := self._media_auth_keys.get(dc_id)) is None:
+                    if (session := await self._create_cached_media_session(dc_id, test_mode)) is not None:
+                        return session
+
+                    auth_key = await Auth(self._client, dc_id, test_mode).create()
+                    session = Session(self._session_client, dc_id, auth_key, test_mode, is_media=True)
+                    await session.start()
+                    try:
+                        await self._import_authorization(session, dc_id)
+                    except:
+                        await session.stop()
+                        raise
+                    self._media_auth_keys[dc_id] = auth_key
+                    if self._auth_cache is not None:
+                        self._auth_cache.set(dc_id, test_mode, await storage.user_id(), auth_key)
+                    return session
+
+        session = Session(self._session_client, dc_id, auth_key, test_mode, is_media=True)
+        await session.start()
+        return session
+
+    async def _create_cached_media_session(self, dc_id: int, test_mode: bool) -> Session | None:
+        if self._auth_cache is None:
+            return None
+        auth_key = self._auth_cache.get(dc_id, test_mode, await self._client.storage.user_id())
+        if auth_key is None:
+            return None
+
+        session = Session(self._session_client, dc_id, auth_key, test_mode, is_media=True)
+        await session.start()
+
+        # Key may have been revoked (e.g. all other sessions were terminated), so it is checked
+        #  with request that requires authorization before it is used for downloads
+        try:
+            await session.invoke(GetUsers(id=[InputUserSelf()]))
+        except AuthKeyUnregistered:
+            await session.stop()
+            self._auth_cache.discard(dc_id, test_mode)
+            return None
+        except:
+            await session.stop()
+            raise
 
-        async with self._client.media_sessions_lock:
-            session = self._client.media_sessions[dc_id] = Session(
-                self._client, dc_id,
-                await Auth(self._client, dc_id, await storage.test_mode()).create()
-                if dc_id != await storage.dc_id()
-                else await storage.auth_key(),
-                await storage.test_mode(),
-                is_media=True
-            )
-            await session.start()
+        self._media_auth_keys[dc_id] = auth_key
+        return session
 
-            if dc_id == await storage.dc_id():
-                return session
+    async def _create_cdn_session(self, dc_id: int) -> Session:
+        storage = self._client.storage
+        session = Session(
+            self._session_client, dc_id, await Auth(self._client, dc_id, await storage.test_mode()).create(),
+            await storage.test_mode(), is_media=True, is_cdn=True
+        )
+        await session.start()
+        return session
 
-            for _ in range(3):
-                exported_auth = await self._client.invoke(ExportAuthorization(dc_id=dc_id))
+    async def _get_file(self, file_id: FileId | FileIdCached, offset: int = 0, limit: int = CHUNK_SIZE) -> bytes:
+        file_type = file_id.file_type
 
-                try:
-                    await session.invoke(
-                        ImportAuthorization(
-                            id=exported_auth.id,
-                            bytes=exported_auth.bytes
-                        )
-                    )
-                except AuthBytesInvalid:
-                    continue
-                else:
-                    break
+        if file_type == FileType.CHAT_PHOTO:
+            if file_id.chat_id > 0:
+                peer = InputPeerUser(user_id=file_id.chat_id, access_hash=file_id.chat_access_hash)
             else:
-                raise AuthBytesInvalid
-
-            return session
-
-    async def _get_file(self, file_id: FileId | FileIdCached, offset: int = 0) -> bytes:
-        async with self._getfile_sem:
-            file_type = file_id.file_type
-
-            if file_type == FileType.CHAT_PHOTO:
-                if file_id.chat_id > 0:
-                    peer = InputPeerUser(user_id=file_id.chat_id, access_hash=file_id.chat_access_hash)
+                if file_id.chat_access_hash == 0:
+                    peer = InputPeerChat(chat_id=-file_id.chat_id)
                 else:
-                    if file_id.chat_access_hash == 0:
-                        peer = InputPeerChat(chat_id=-file_id.chat_id)
-                    else:
-                        peer = InputPeerChannel(
-                            channel_id=get_channel_id(file_id.chat_id), access_hash=file_id.chat_access_hash
-                        )
+                    peer = InputPeerChannel(
+                        channel_id=get_channel_id(file_id.chat_id), access_hash=file_id.chat_access_hash
+                    )
 
-                location = InputPeerPhotoFileLocation(
-                    peer=peer,
-                    photo_id=file_id.media_id,
-                    big=file_id.thumbnail_source == ThumbnailSource.CHAT_PHOTO_BIG
-                )
-            elif file_type == FileType.PHOTO:
-                location = InputPhotoFileLocation(
-                    id=file_id.media_id,
-                    access_hash=file_id.access_hash,
-                    file_reference=file_id.file_reference,
-                    thumb_size=file_id.thumbnail_size
-                )
-            else:
-                location = InputDocumentFileLocation(
-                    id=file_id.media_id,
-                    access_hash=file_id.access_hash,
-                    file_reference=file_id.file_reference,
-                    thumb_size=file_id.thumbnail_size
-                )
+            location = InputPeerPhotoFileLocation(
+                peer=peer,
+                photo_id=file_id.media_id,
+                big=file_id.thumbnail_source == ThumbnailSource.CHAT_PHOTO_BIG
+            )
+        elif file_type == FileType.PHOTO:
+            location = InputPhotoFileLocation(
+                id=file_id.media_id,
+                access_hash=file_id.access_hash,
+                file_reference=file_id.file_reference,
+                thumb_size=file_id.thumbnail_size
+            )
+        else:
+            location = InputDocumentFileLocation(
+                id=file_id.media_id,
+                access_hash=file_id.access_hash,
+                file_reference=file_id.file_reference,
+                thumb_size=file_id.thumbnail_size
+            )
 
-            request = GetFile(location=location, offset=offset, limit=CHUNK_SIZE)
+        request = GetFile(location=location, offset=offset, limit=limit)
 
-            session = await self._get_media_session(file_id.dc_id)
+        breaker = self._breakers[file_id.dc_id]
+        retries = 5
+        for i in range(retries):
+            try:
+                async with self._concurrency:
+                    start = time()
+                    async with self._media_sessions.session(file_id.dc_id) as session:
+                        chunk = await self._get_file_chunk(session, request, offset)
+                    self._concurrency.on_success(time() - start, limit)
+                    breaker.on_success()
+                    return chunk
+            except FloodWait as e:
+                # Dc is alive and answers, it just asks to slow down. Chunk is requested again after pause
+                #  by _download_task_wrapper, so it does not hold download slot or memory budget while waiting.
+                breaker.on_success()
+                self._concurrency.on_congestion()
+                self._flood_until[file_id.dc_id] = max(self._flood_until.get(file_id.dc_id, 0), time() + e.value)
+                raise
+            except TimeoutError:
+                breaker.on_failure()
+                self._concurrency.on_congestion()
+                raise
+            except AuthKeyUnregistered:
+                self._concurrency.on_error()
+                if self._media_auth_keys.pop(file_id.dc_id, None) is not None and self._auth_cache is not None:
+                    self._auth_cache.discard(file_id.dc_id, await self._client.storage.test_mode())
+                if i == (retries - 1):
+                    raise
+                await sleep(self._retry.delay(i + 1))
+            except (FileReferenceInvalid, FileReferenceExpired):
+                breaker.on_success()
+                raise
+            except Exception:
+                breaker.on_failure()
+                self._concurrency.on_error()
+                raise
 
-            retries = 5
-            for i in range(retries):
-                try:
-                    r = await session.invoke(request, sleep_threshold=self._client.sleep_threshold)
-                    break
-                except AuthKeyUnregistered:
-                    if i == (retries - 1):
-                        raise
+        raise RuntimeError("Failed to download file chunk")
 
-            if not isinstance(r, (File, FileCdnRedirect)):
-                raise ValueError(f"Expected File or FileCdnRedirect, got {r.__class__.__name__}")
+    async def _get_file_chunk(self, session: Session, request: GetFile, offset: int) -> bytes:
+        # Requests are sent with sleep_threshold=0 (and session is created with FloodWaitClient), so flood waits
+        #  of any length are raised to _get_file instead of being slept through with session and download slot held
+        r = await session.invoke(request, sleep_threshold=0)
 
-            if isinstance(r, File):
-                return r.bytes
+        if not isinstance(r, (File, FileCdnRedirect)):
+            raise ValueError(f"Expected File or FileCdnRedirect, got {r.__class__.__name__}")
 
-            storage = self._client.storage
-            cdn_session = Session(
-                self._client, r.dc_id, await Auth(self._client, r.dc_id, await storage.test_mode()).create(),
-                await storage.test_mode(), is_media=True, is_cdn=True
-            )
+        if isinstance(r, File):
+            return r.bytes
 
-            try:
-                await cdn_session.start()
-
-                while True:
-                    r2 = await cdn_session.invoke(
-                        GetCdnFile(
-                            file_token=r.file_token,
-                            offset=offset,
-                            limit=CHUNK_SIZE
-                        )
-                    )
+        self._cdn_hashes.add(r.file_token, r.file_hashes)
 
-                    if isinstance(r2, CdnFileReuploadNeeded):
-                        try:
-                            await session.invoke(
-                                ReuploadCdnFile(
-                                    file_token=r.file_token,
-                                    request_token=r2.request_token
-                                )
-                            )
-                        except VolumeLocNotFound:
-                            raise
-                        else:
-                            continue
-
-                    chunk = r2.bytes
-
-                    # https://core.telegram.org/cdn#decrypting-files
-                    decrypted_chunk = aes.ctr256_decrypt(
-                        chunk,
-                        r.encryption_key,
-                        bytearray(
-                            r.encryption_iv[:-4]
-                            + (offset // 16).to_bytes(4, "big")
-                        )
-                    )
+        # Chunks smaller than hash part (and their offsets) are not aligned to parts that cdn hashes cover,
+        #  so whole part that contains chunk is requested and verified, and chunk is cut out of it
+        part_offset = offset - offset % CDN_HASH_PART_SIZE
+        part_limit = max(request.limit, CDN_HASH_PART_SIZE)
 
-                    hashes = await session.invoke(GetCdnFileHashes(file_token=r.file_token, offset=offset))
+        async with self._cdn_sessions.session(r.dc_id) as cdn_session:
+            while True:
+                r2 = await cdn_session.invoke(
+                    GetCdnFile(
+                        file_token=r.file_token,
+                        offset=part_offset,
+                        limit=part_limit
+                    ),
+                    sleep_threshold=0,
+                )
 
-                    # https://core.telegram.org/cdn#verifying-files
-                    for i, h in enumerate(hashes):
-                        cdn_chunk = decrypted_chunk[h.limit * i: h.limit * (i + 1)]
-                        CDNFileHashMismatch.check(
-                            h.hash == sha256(cdn_chunk).digest(),
-                            "h.hash == sha256(cdn_chunk).digest()"
+                if isinstance(r2, CdnFileReuploadNeeded):
+                    try:
+                        await session.invoke(
+                            ReuploadCdnFile(
+                                file_token=r.file_token,
+                                request_token=r2.request_token
+                            ),
+                            sleep_threshold=0,
                         )
+                    except VolumeLocNotFound:
+                        raise
+                    else:
+                        continue
 
-                    return decrypted_chunk
-            except:
-                raise
-            finally:
-                await cdn_session.stop()
+                hashes = await self._cdn_hashes.get(session, r.file_token, part_offset, len(r2.bytes))
 
-            raise RuntimeError("Failed to download file chunk")
+                decrypted_chunk = await self._loop.run_in_executor(
+                    self._hash_executor, self._decrypt_cdn_chunk,
+                    r2.bytes, r.encryption_key, r.encryption_iv, part_offset, hashes,
+                )
+                return decrypted_chunk[offset - part_offset:offset - part_offset + request.limit]
 
     @staticmethod
-    def _open_file(path: Path, size: int) -> BinaryIO:
-        fp = open(path, "wb")
-        fp.truncate(size)
-        return fp
+    def _decrypt_cdn_chunk(chunk: bytes, key: bytes, iv: bytes, offset: int, hashes: list[FileHash]) -> bytes:
+        # https://core.telegram.org/cdn#decrypting-files
+        decrypted_chunk = aes.ctr256_decrypt(chunk, key, bytearray(iv[:-4] + (offset // 16).to_bytes(4, "big")))
+
+        # https://core.telegram.org/cdn#verifying-files
+        for h in hashes:
+            cdn_chunk = decrypted_chunk[h.offset - offset:h.offset - offset + h.limit]
+            CDNFileHashMismatch.check(
+                h.hash == sha256(cdn_chunk).digest(),
+                "h.hash == sha256(cdn_chunk).digest()"
+            )
+
+        return decrypted_chunk
 
     @staticmethod
-    def _write_file(file: BinaryIO, offset: int, data: bytes) -> None:
-        file.seek(offset)
-        file.write(data)
+    def _open_file(path: Path, size: int, chunk_size: int) -> tuple[ChunkFile | None, set[int]]:
+        all_chunks = set(range(0, max(size, 1), chunk_size))
+
+        # Files that fit into one chunk are written at once and without preallocation,
+        #  so existing file with expected size is always complete.
+        if size <= chunk_size:
+            if path.exists() and path.stat().st_size == size:
+                return None, all_chunks
+            return ChunkFile(path, None, True), set()
+
+        manifest = ChunkManifest(path)
+        if path.exists():
+            if not manifest.exists():
+                if path.stat().st_size == size:
+                    return None, all_chunks
+            elif (done_chunks := manifest.load(size, chunk_size)) is not None:
+                manifest.open()
+                return ChunkFile(path, manifest, False), done_chunks
+
+        # Manifest is created before file, so file without manifest is never partially downloaded
+        manifest.create(size, chunk_size)
+        file = ChunkFile(path, manifest, True)
+        file.preallocate(size)
+        return file, set()
+
+    async def _write_chunk(self, file: ChunkFile, offset: int, chunk: bytes) -> None:
+        if not self._coalesce_writes:
+            return await self._loop.run_in_executor(self._write_executor, file.write, offset, [chunk])
+
+        fut = self._loop.create_future()
+        file.pending.append((offset, chunk, fut))
+        if not file.flushing:
+            file.flushing = True
+            self._loop.create_task(self._flush_chunks(file))
+
+        await fut
+
+    async def _flush_chunks(self, file: ChunkFile) -> None:
+        try:
+            while file.pending:
+                pending, file.pending = sorted(file.pending, key=lambda p: p[0]), []
+
+                # Adjacent chunks are written with one pwritev call
+                runs: list[tuple[int, list[bytes], list[Future]]] = []
+                for offset, chunk, fut in pending:
+                    if runs and runs[-1][0] + sum(map(len, runs[-1][1])) == offset:
+                        runs[-1][1].append(chunk)
+                        runs[-1][2].append(fut)
+                    else:
+                        runs.append((offset, [chunk], [fut]))
+
+                for offset, chunks, futures in runs:
+                    try:
+                        await self._loop.run_in_executor(self._write_executor, file.write, offset, chunks)
+                    except Exception as e:
+                        for fut in futures:
+                            if not fut.done():
+                                fut.set_exception(e)
+                    else:
+                        for fut in futures:
+                            if not fut.done():
+                                fut.set_result(None)
+        finally:
+            file.flushing = False
 
     async def _download_task(self, task: DownloadTask, chunk_offset: int) -> None:
         if chunk_offset > task.size:
             return
 
         async with task.lock:
-            if task.file is None:
-                task.file = await self._loop.run_in_executor(
+            if task.done_chunks is None:
+                task.file, task.done_chunks = await self._loop.run_in_executor(
                     self._write_executor, self._open_file,
-                    task.output_path, task.size,
+                    task.output_path, task.size, task.chunk_size,
                 )
 
-        file_id = FileId.decode(task.file_id)
-        chunk = await self._get_file(file_id, chunk_offset)
+        if chunk_offset in task.done_chunks:
+            return
 
-        async with task.lock:
-            await self._loop.run_in_executor(
-                self._write_executor, self._write_file,
-                task.file, chunk_offset, chunk,
-            )
-            task.wrote_bytes += len(chunk)
+        limit = get_request_limit(chunk_offset, task.size, task.chunk_size)
+        reserved = min(limit, task.size - chunk_offset)
 
-    async def _download_task_wrapper(self, task: DownloadTask, chunk_offset: int | None = None) -> None:
-        async with task.lock:
-            task.active_tasks += 1
-            if chunk_offset is None:
-                chunk_offset, task.offset = task.offset, task.offset + CHUNK_SIZE
-            else:
-                task.failed_chunks.discard(chunk_offset)
+        # Bandwidth is paid for before request is sent, so throttled requests do not hold memory or download slots
+        await self._bandwidth.consume(reserved)
+        if (dc_bandwidth := self._dc_bandwidth.get(task.dc_id)) is not None:
+            await dc_bandwidth.consume(reserved)
 
+        await self._memory.acquire(reserved)
+        try:
+            file_id = FileId.decode(task.file_id)
+            chunk = await self._get_file(file_id, chunk_offset, limit)
+            # Short chunk would leave zeroes in preallocated file, so it is retried instead of being marked as done.
+            #  Size 0 means that it is not known (and file is downloaded in one chunk).
+            if task.size > 0 and len(chunk) != reserved:
+                raise ValueError(f"Expected {reserved} bytes at offset {chunk_offset}, got {len(chunk)}")
+
+            await self._write_chunk(task.file, chunk_offset, chunk)
+            task.wrote_bytes += len(chunk)
+            task.done_chunks.add(chunk_offset)
+        finally:
+            self._memory.release(reserved)
+
+    async def _download_task_wrapper(self, task: DownloadTask, chunk_offset: int) -> None:
         try:
             await self._download_task(task, chunk_offset)
         except (FileReferenceInvalid, FileReferenceExpired):
             task.need_fileref_renew = True
-            async with task.lock:
-                task.failed_chunks.add(chunk_offset)
+            task.failed_chunks.add(chunk_offset)
+        except FloodWait:
+            # Not an error of this file, chunk is requested again when flood wait of its dc is over
+            task.failed_chunks.add(chunk_offset)
+        except Exception as e:
+            self._on_task_error(task, chunk_offset, e)
         except:
-            async with task.lock:
-                task.failed_chunks.add(chunk_offset)
+            task.failed_chunks.add(chunk_offset)
             raise
         finally:
-            async with task.lock:
-                task.active_tasks -= 1
-
-        self._tasks_changed.set()
+            task.active_tasks -= 1
+            if task.is_small:
+                self._running_small -= 1
+            else:
+                self._running_large -= 1
+            self._task_changed(task)
 
     async def _loop_func(self) -> None:
-        idx_hi = 0
-        idx_lo = 0
+        while self._running or self._tasks_count or self._store.pending or self._running_tasks:
+            self._fill_working_set()
+            self._maybe_renew_filerefs()
+            timeout = self._wake_delayed()
+            if self._need_renew_tasks:
+                timeout = min(timeout or 0.1, 0.1)
+
+            task = None
+            if len(self._running_tasks) <= self._concurrency.limit:
+                task = self._next_task()
+
+            if task is not None and not (breaker := self._breakers[task.dc_id]).allow():
+                # Dc is paused after series of failures, its tasks wait while other dcs keep downloading
+                if (time() - breaker.opened_at) > self._retry.max_dc_pause:
+                    task.queue.discard(task)
+                    task.error = f"DC{task.dc_id} is unavailable"
+                    self._task_changed(task)
+                else:
+                    task.retry_at = breaker.retry_at()
+                    self._delay(task)
+                continue
 
-        while self._running or self._tasks_hi or self._tasks_lo or self._running_tasks:
-            count_hi = len(self._tasks_hi)
-            count_lo = len(self._tasks_lo)
+            if task is not None and self._flood_until.get(task.dc_id, 0) > time():
+                task.retry_at = self._flood_until[task.dc_id]
+                self._delay(task)
+                continue
 
-            if (not count_hi and not count_lo) or (len(self._running_tasks) >= self._max_concurrent_tasks):
+            if task is None:
                 try:
-                    await asyncio.wait_for(self._tasks_changed.wait(), timeout=0.1)
+                    await asyncio.wait_for(self._tasks_changed.wait(), timeout=timeout)
                 except TimeoutError:
                     ...
                 else:
                     self._tasks_changed.clear()
                 continue
 
-            task = None
-
-            to_check = (
-                (self._tasks_hi, count_hi, idx_hi, True),
-                (self._tasks_lo, count_lo, idx_lo, False),
-            )
-
-            for tasks, count, start_idx, is_high in to_check:
-                for idx in range(count):
-                    if (idx % 10) == 0:
-                        await sleep(0)
-
-                    if not tasks:
-                        continue
-
-                    task_idx = (start_idx + idx) % len(tasks)
-                    task_check = tasks[task_idx]
-                    if task_check.offset >= task_check.size and not task_check.failed_chunks:
-                        continue
-                    if task_check.need_fileref_renew:
-                        if task_check not in self._renewing_tasks:
-                            if not self._need_renew_tasks:
-                                self._last_renew_time = time()
-                            self._need_renew_tasks.add(task_check)
-                        continue
-
-                    task = task_check
-                    if is_high:
-                        idx_hi = task_idx
-                    else:
-                        idx_lo = task_idx
-
-                    break
-
-                if task is not None:
-                    break
-
-            if task is not None:
-                async with task.lock:
-                    chunk_index = task.failed_chunks.pop() if task.failed_chunks else None
-                new_task = self._loop.create_task(self._download_task_wrapper(task, chunk_index))
-                self._running_tasks.add(new_task)
-                new_task.add_done_callback(self._running_tasks.remove)
-
-            if self._need_renew_tasks \
-                    and ((time() - self._last_renew_time) > 5 or len(self._need_renew_tasks) >= 100) \
-                    and self._renew_task is None:
-                self._renew_task = self._loop.create_task(self._renew_filerefs())
-                self._renew_task.add_done_callback(lambda _: setattr(self, "_renew_task", None))
-                self._last_renew_time = time()
-
+            self._dispatch(task)
             await sleep(0)
 
-            for tasks, _, _, _ in to_check:
-                await sleep(0)
-                to_remove = []
-
-                for rem_idx, task in enumerate(tasks):
-                    if task.wrote_bytes < task.size or task.active_tasks > 0 or task.failed_chunks or not task.file:
-                        continue
-
-                    to_remove.append(rem_idx)
-
-                for rem_idx in reversed(to_remove):
-                    await sleep(0)
-                    task = tasks.pop(rem_idx)
-                    task.file.close()
-                    task.done.set()
-
-                if to_remove:
-                    self._tasks_changed.set()
-
     def start(self) -> None:
         if self._running and self._loop_task:
             return
@@ -467,8 +1043,13 @@ class Downloader:
         self._running = True
         self._loop_task = self._loop.create_task(self._loop_func())
 
+        # Tasks left in queue by previous run
+        for dc_id in self._store.pending_dcs():
+            self._warm_up(dc_id)
+
     async def stop(self) -> None:
         self._running = False
+        self._tasks_changed.set()
         if self._loop_task is None:
             return
         try:
@@ -476,3 +1057,9 @@ class Downloader:
         except:
             ...
         self._loop_task = None
+        for task in list(self._warmup_tasks):
+            task.cancel()
+        await self._media_sessions.close()
+        await self._cdn_sessions.close()
+        self._hash_executor.shutdown(wait=False)
+        self._store.close()
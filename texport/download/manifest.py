@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+MANIFEST_SUFFIX = ".texport-part"
+
+
+class ChunkManifest:
+    __slots__ = ("path", "_fd",)
+
+    def __init__(self, output_path: Path) -> None:
+        self.path = output_path.with_name(output_path.name + MANIFEST_SUFFIX)
+        self._fd: int | None = None
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def load(self, size: int, chunk_size: int) -> set[int] | None:
+        try:
+            with open(self.path, "r", encoding="utf8") as f:
+                lines = f.read().split("\n")
+        except OSError:
+            return None
+
+        # Last element is either empty string or partially written line
+        lines = lines[:-1]
+        if not lines or lines[0] != f"{size} {chunk_size}":
+            return None
+
+        try:
+            return {int(line) for line in lines[1:]}
+        except ValueError:
+            return None
+
+    def _open(self, flags: int) -> None:
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | getattr(os, "O_BINARY", 0) | flags, 0o644)
+
+    def create(self, size: int, chunk_size: int) -> None:
+        self._open(os.O_CREAT | os.O_TRUNC)
+        os.write(self._fd, f"{size} {chunk_size}\n".encode("utf8"))
+
+    def open(self) -> None:
+        self._open(0)
+
+    def add(self, offset: int) -> None:
+        # Single O_APPEND write of whole line, so it is safe to call from several threads at once
+        os.write(self._fd, f"{offset}\n".encode("utf8"))
+
+    def close(self) -> None:
+        # Manifest is kept on disk, so download can be continued later
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def remove(self) -> None:
+        self.close()
+        self.path.unlink(missing_ok=True)
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+from hashlib import sha1
+from pathlib import Path
+from time import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl(dest_fd, FICLONE, src_fd) makes copy-on-write copy on btrfs, xfs and other filesystems that support it
+_FICLONE = 0x40049409
+
+
+def _reflink(src: Path, dst: Path) -> bool:
+    if fcntl is None:
+        return False
+
+    try:
+        src_f = open(src, "rb")
+    except OSError:
+        return False
+
+    with src_f:
+        try:
+            dst_f = open(dst, "xb")
+        except OSError:
+            return False
+
+        with dst_f:
+            try:
+                fcntl.ioctl(dst_f.fileno(), _FICLONE, src_f.fileno())
+                return True
+            except OSError:
+                ...
+
+    dst.unlink(missing_ok=True)
+    return False
+
+
+def link_file(src: Path, dst: Path) -> bool:
+    # Files are never copied, so linking is metadata-only operation and is fine to do on event loop
+    if _reflink(src, dst):
+        return True
+
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:
+        return False
+
+
+class MediaCache:
+    def __init__(self, directory: Path, limit: int) -> None:
+        # Cache is shared between exports (and processes), so index is kept in sqlite database in cache directory.
+        #  Files are evicted in least recently used order when total size goes over limit (in bytes, 0 is unlimited).
+        self._dir = directory
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._limit = limit
+        # Index can be locked by other process for a while, so cache is used from its own thread, not from event loop
+        self._db = sqlite3.connect(
+            self._dir / "index.sqlite", timeout=30, isolation_level=None, check_same_thread=False,
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS files_lru ON files (last_used)")
+        # Total size of cached files is only summed when cache is opened and is then kept up to date by this instance,
+        #  so it does not include files stored by other processes until they are evicted by this one
+        self._total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str) -> Path:
+        return self._dir / sha1(key.encode("utf8")).hexdigest()[:2] / key
+
+    def materialize(self, key: str, size: int, output_path: Path) -> bool:
+        row = self._db.execute("SELECT size FROM files WHERE key = ?", (key,)).fetchone()
+        path = self._path(key)
+        if row is None or row[0] != size or not link_file(path, output_path):
+            if row is not None and not path.exists():
+                self._delete(key, row[0])
+            self.misses += 1
+            return False
+
+        self._db.execute("UPDATE files SET last_used = ? WHERE key = ?", (time(), key))
+        self.hits += 1
+        return True
+
+    def store(self, key: str, size: int, file_path: Path) -> None:
+        if self._limit and size > self._limit:
+            return
+
+        path = self._path(key)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            if not link_file(file_path, path):
+                return
+
+        row = self._db.execute("SELECT size FROM files WHERE key = ?", (key,)).fetchone()
+        self._db.execute(
+            "INSERT OR REPLACE INTO files (key, size, last_used) VALUES (?, ?, ?)", (key, size, time()),
+        )
+        self._total += size - (row[0] if row is not None else 0)
+        self._evict()
+
+    def _delete(self, key: str, size: int) -> None:
+        # Row may have already been deleted by other process, its size is not subtracted twice then
+        if self._db.execute("DELETE FROM files WHERE key = ?", (key,)).rowcount:
+            self._total -= size
+
+    def _evict(self) -> None:
+        if not self._limit:
+            return
+
+        while self._total > self._limit:
+            rows = self._db.execute("SELECT key, size FROM files ORDER BY last_used LIMIT 64").fetchall()
+            if not rows:
+                self._total = 0
+                break
+            for key, size in rows:
+                self._path(key).unlink(missing_ok=True)
+                self._delete(key, size)
+                if self._total <= self._limit:
+                    break
+
+    def close(self) -> None:
+        self._db.close()
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+from random import uniform
+from time import time
+from typing import NamedTuple
+
+
+class RetryPolicy:
+    __slots__ = ("base_delay", "max_delay", "error_budget", "max_dc_pause",)
+
+    def __init__(
+            self, base_delay: float = 0.5, max_delay: float = 60, error_budget: int = 10, max_dc_pause: float = 600,
+    ) -> None:
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Number of failed requests after which file is given up on
+        self.error_budget = max(error_budget, 1)
+        # Files from dc that stays paused for this long are given up on too, otherwise export would never finish
+        self.max_dc_pause = max_dc_pause
+
+    def delay(self, errors: int) -> float:
+        # Exponential backoff with full jitter, so chunks that failed together are not retried together
+        return uniform(0, min(self.max_delay, self.base_delay * 2 ** (errors - 1)))
+
+
+class CircuitBreaker:
+    __slots__ = ("_threshold", "_reset_timeout", "_failures", "open_until", "opened_at", "_probe_started",)
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30) -> None:
+        # After "threshold" consecutive failures requests to dc are paused for "reset_timeout" seconds,
+        #  then one request is let through: dc is closed again if it succeeds and paused again if it fails
+        self._threshold = threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self.open_until = 0.0
+        # When dc was paused first time since last successful request
+        self.opened_at = 0.0
+        self._probe_started = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return self.open_until > 0
+
+    def allow(self) -> bool:
+        if not self.open_until:
+            return True
+
+        now = time()
+        if now < self.open_until:
+            return False
+        # Probe that was not finished in time (e.g. it was cancelled) does not block dc forever
+        if self._probe_started and (now - self._probe_started) < self._reset_timeout:
+            return False
+
+        self._probe_started = now
+        return True
+
+    def retry_at(self) -> float:
+        # While probe request is in flight, paused tasks check again every second
+        now = time()
+        return self.open_until if now < self.open_until else now + 1
+
+    def on_success(self) -> None:
+        self._failures = 0
+        self.open_until = 0.0
+        self.opened_at = 0.0
+        self._probe_started = 0.0
+
+    def on_failure(self) -> None:
+        self._failures += 1
+        if self._probe_started or self._failures >= self._threshold:
+            self.open_until = time() + self._reset_timeout
+            self.opened_at = self.opened_at or time()
+            self._probe_started = 0.0
+
+
+class FailedDownload(NamedTuple):
+    message_id: int
+    chat_id: int
+    output_path: str
+    size: int
+    error: str
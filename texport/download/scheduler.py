@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+from collections import deque
+from heapq import heappush, heappop, heapify
+from typing import TYPE_CHECKING, Callable, Any
+
+if TYPE_CHECKING:
+    from .downloader import DownloadTask
+
+
+def _task_id_key(task: DownloadTask) -> int:
+    return task.task_id
+
+
+class ReadyQueue:
+    __slots__ = ("_heap", "_size", "_key",)
+
+    def __init__(self, key: Callable[[DownloadTask], Any] = _task_id_key) -> None:
+        # Entries are (key, queue_gen, task). Entries whose queue_gen does not match task's current one are stale
+        #  (task was moved to another queue or removed) and are dropped lazily when they reach top of the heap.
+        self._heap: list[tuple[Any, int, DownloadTask]] = []
+        self._size = 0
+        self._key = key
+
+    def __len__(self) -> int:
+        return self._size
+
+    def push(self, task: DownloadTask) -> None:
+        if task.queue is self:
+            return
+        if task.queue is not None:
+            task.queue.discard(task)
+
+        task.queue = self
+        task.queue_gen += 1
+        self._size += 1
+        heappush(self._heap, (self._key(task), task.queue_gen, task))
+
+        if len(self._heap) > self._size * 2 + 64:
+            self._compact()
+
+    def discard(self, task: DownloadTask) -> None:
+        if task.queue is not self:
+            return
+
+        task.queue = None
+        task.queue_gen += 1
+        self._size -= 1
+
+    def peek(self) -> DownloadTask | None:
+        heap = self._heap
+        while heap:
+            _, gen, task = heap[0]
+            if task.queue is self and task.queue_gen == gen:
+                return task
+            heappop(heap)
+
+        return None
+
+    def pop(self) -> DownloadTask | None:
+        task = self.peek()
+        if task is not None:
+            heappop(self._heap)
+            self.discard(task)
+        return task
+
+    def rotate(self) -> None:
+        ...
+
+    def _compact(self) -> None:
+        self._heap = [entry for entry in self._heap if entry[2].queue is self and entry[2].queue_gen == entry[1]]
+        heapify(self._heap)
+
+
+class FairReadyQueue:
+    __slots__ = ("_queues", "_order", "_weights", "_credit",)
+
+    def __init__(self) -> None:
+        # Chats are served in round-robin order, each chat gets "weight" chunks per turn.
+        #  Inside of one chat tasks are served by task id.
+        self._queues: dict[int, ReadyQueue] = {}
+        self._order: deque[int] = deque()
+        self._weights: dict[int, int] = {}
+        self._credit = 0
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def set_weight(self, chat_id: int, weight: int) -> None:
+        self._weights[chat_id] = max(weight, 1)
+
+    def push(self, task: DownloadTask) -> None:
+        queue = self._queues.get(task.chat_id)
+        if queue is None:
+            queue = self._queues[task.chat_id] = ReadyQueue()
+            self._order.append(task.chat_id)
+
+        queue.push(task)
+
+    @staticmethod
+    def discard(task: DownloadTask) -> None:
+        if task.queue is not None:
+            task.queue.discard(task)
+
+    def peek(self) -> DownloadTask | None:
+        while self._order:
+            chat_id = self._order[0]
+            task = self._queues[chat_id].peek()
+            if task is not None:
+                return task
+
+            del self._queues[chat_id]
+            self._order.popleft()
+            self._credit = 0
+
+        return None
+
+    def rotate(self) -> None:
+        if not self._order:
+            return
+
+        self._credit += 1
+        if self._credit >= self._weights.get(self._order[0], 1):
+            self._order.rotate(-1)
+            self._credit = 0
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+from asyncio import Condition, Task, sleep, get_running_loop
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from time import time
+from typing import Callable, Awaitable, AsyncIterator
+
+from pyrogram import Client
+from pyrogram.errors import AuthKeyUnregistered
+from pyrogram.session import Session
+
+
+class FloodWaitClient:
+    __slots__ = ("_client",)
+
+    # Session.invoke sleeps through flood waits up to max(sleep_threshold, client.sleep_threshold), so passing
+    #  sleep_threshold=0 to invoke is not enough. Sessions created with this view of client raise every FloodWait
+    #  to caller, which can then release its slot and pause other requests too.
+    sleep_threshold = 0
+
+    def __init__(self, client: Client) -> None:
+        object.__setattr__(self, "_client", client)
+
+    def __getattr__(self, name: str):
+        return getattr(self._client, name)
+
+    def __setattr__(self, name: str, value) -> None:
+        setattr(self._client, name, value)
+
+
+class PooledSession:
+    __slots__ = ("session", "dc_id", "in_flight", "last_used",)
+
+    def __init__(self, session: Session, dc_id: int) -> None:
+        self.session = session
+        self.dc_id = dc_id
+        self.in_flight = 0
+        self.last_used = time()
+
+
+class SessionPool:
+    def __init__(
+            self, factory: Callable[[int], Awaitable[Session]], max_sessions: int, idle_timeout: float = 60,
+            keep_alive: Callable[[int], bool] | None = None,
+    ) -> None:
+        self._factory = factory
+        # Returns True for dcs that still have queued work, last idle session to such dc is not closed
+        self._keep_alive = keep_alive
+        self._max_sessions = max(max_sessions, 1)
+        self._idle_timeout = idle_timeout
+
+        self._sessions: dict[int, list[PooledSession]] = defaultdict(list)
+        self._creating: dict[int, int] = defaultdict(int)
+        self._changed = Condition()
+        self._reaper: Task | None = None
+
+    async def _acquire(self, dc_id: int) -> PooledSession:
+        async with self._changed:
+            while True:
+                sessions = self._sessions[dc_id]
+                can_create = len(sessions) + self._creating[dc_id] < self._max_sessions
+                best = min(sessions, key=lambda s: s.in_flight, default=None)
+                if best is not None and (best.in_flight == 0 or not can_create):
+                    best.in_flight += 1
+                    return best
+                if can_create:
+                    break
+                await self._changed.wait()
+
+            self._creating[dc_id] += 1
+
+        pooled = await self._create(dc_id)
+        pooled.in_flight += 1
+        return pooled
+
+    async def _create(self, dc_id: int) -> PooledSession:
+        try:
+            pooled = PooledSession(await self._factory(dc_id), dc_id)
+        finally:
+            async with self._changed:
+                self._creating[dc_id] -= 1
+                self._changed.notify_all()
+
+        self._sessions[dc_id].append(pooled)
+        if self._reaper is None:
+            self._reaper = get_running_loop().create_task(self._reap_idle())
+
+        return pooled
+
+    async def warm_up(self, dc_id: int) -> None:
+        async with self._changed:
+            if self._sessions[dc_id] or self._creating[dc_id]:
+                return
+            self._creating[dc_id] += 1
+
+        await self._create(dc_id)
+
+    async def _release(self, pooled: PooledSession, failed: bool) -> None:
+        pooled.in_flight -= 1
+        pooled.last_used = time()
+
+        if failed:
+            sessions = self._sessions[pooled.dc_id]
+            if pooled in sessions:
+                sessions.remove(pooled)
+                await self._stop_session(pooled)
+
+        async with self._changed:
+            self._changed.notify_all()
+
+    def loads(self) -> dict[int, list[int]]:
+        return {
+            dc_id: [pooled.in_flight for pooled in sessions]
+            for dc_id, sessions in self._sessions.items()
+            if sessions
+        }
+
+    @asynccontextmanager
+    async def session(self, dc_id: int) -> AsyncIterator[Session]:
+        pooled = await self._acquire(dc_id)
+        failed = False
+        try:
+            yield pooled.session
+        except (OSError, TimeoutError, AuthKeyUnregistered):
+            # Connection is probably broken or key is not valid anymore,
+            #  so session is dropped and new one will be created on next acquire
+            failed = True
+            raise
+        finally:
+            await self._release(pooled, failed)
+
+    @staticmethod
+    async def _stop_session(pooled: PooledSession) -> None:
+        try:
+            await pooled.session.stop()
+        except Exception:
+            ...
+
+    async def _reap_idle(self) -> None:
+        while any(self._sessions.values()):
+            await sleep(self._idle_timeout / 2)
+
+            now = time()
+            for dc_id, sessions in list(self._sessions.items()):
+                idle = [
+                    pooled for pooled in sessions
+                    if not pooled.in_flight and (now - pooled.last_used) > self._idle_timeout
+                ]
+                if idle and len(idle) == len(sessions) and self._keep_alive is not None and self._keep_alive(dc_id):
+                    idle.pop()
+                for pooled in idle:
+                    sessions.remove(pooled)
+                    await self._stop_session(pooled)
+
+        self._reaper = None
+
+    async def close(self) -> None:
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+
+        for sessions in list(self._sessions.values()):
+            for pooled in sessions:
+                await self._stop_session(pooled)
+            sessions.clear()
@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import sqlite3
+from pathlib import Path
+from typing import NamedTuple
+
+STATE_PENDING = 0
+STATE_ACTIVE = 1
+STATE_DONE = 2
+STATE_FAILED = 3
+
+_COLUMNS = "id, file_id, message_id, chat_id, output_path, size, is_thumb, chunk_size, high_priority, dc_id"
+
+
+class StoredTask(NamedTuple):
+    task_id: int
+    file_id: str
+    message_id: int
+    chat_id: int
+    output_path: str
+    size: int
+    is_thumb: bool
+    chunk_size: int
+    high_priority: bool
+    dc_id: int
+
+
+class AddedTask(NamedTuple):
+    task_id: int
+    output_path: str
+    size: int
+    done: bool
+    created: bool
+    # Set when task already failed in this run, done is set too
+    error: str | None = None
+
+
+class TaskStore:
+    def __init__(self, path: Path | None = None, commit_every: int = 256) -> None:
+        # Queue of not yet materialized download tasks. Only working set of tasks is kept in memory,
+        #  everything else lives here (on disk when path is set, so queue survives restarts).
+        self._db = sqlite3.connect(path or ":memory:")
+        if path is not None:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                media_key TEXT NOT NULL UNIQUE,
+                file_id TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                output_path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                is_thumb INTEGER NOT NULL,
+                chunk_size INTEGER NOT NULL,
+                high_priority INTEGER NOT NULL DEFAULT 0,
+                dc_id INTEGER NOT NULL DEFAULT 0,
+                state INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS tasks_chat ON tasks (state, chat_id, high_priority, id);
+            CREATE INDEX IF NOT EXISTS tasks_priority ON tasks (state, high_priority, id);
+        """)
+
+        # Tasks that were being downloaded when previous run stopped (or failed in it) are pending again,
+        #  already downloaded chunks are picked up from chunk manifests
+        self._db.execute(
+            "UPDATE tasks SET state = ? WHERE state IN (?, ?)", (STATE_PENDING, STATE_ACTIVE, STATE_FAILED),
+        )
+        self._db.commit()
+
+        self._commit_every = commit_every
+        self._changes = 0
+        # Task id -> error of tasks failed in this run (failed tasks are retried by next run, so it is not stored)
+        self._errors: dict[int, str] = {}
+
+        # Chat id -> number of pending tasks, to spread working set between chats without scanning the table
+        self._pending_chats: dict[int, int] = dict(self._db.execute(
+            "SELECT chat_id, COUNT(*) FROM tasks WHERE state = ? GROUP BY chat_id", (STATE_PENDING,),
+        ).fetchall())
+        self.pending = sum(self._pending_chats.values())
+        # Dc id -> number of pending tasks, used to plan media sessions before tasks are materialized
+        self._pending_dcs: dict[int, int] = dict(self._db.execute(
+            "SELECT dc_id, COUNT(*) FROM tasks WHERE state = ? GROUP BY dc_id", (STATE_PENDING,),
+        ).fetchall())
+        self.total_bytes, self.done_bytes = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0), COALESCE(SUM(CASE WHEN state = ? THEN size ELSE 0 END), 0) FROM tasks",
+            (STATE_DONE,),
+        ).fetchone()
+
+    def _changed(self, count: int = 1) -> None:
+        self._changes += count
+        if self._changes >= self._commit_every:
+            self.commit()
+
+    def commit(self) -> None:
+        self._db.commit()
+        self._changes = 0
+
+    def add(
+            self, media_key: str, file_id: str, message_id: int, chat_id: int, output_path: Path, size: int,
+            is_thumb: bool, chunk_size: int, high_priority: bool, dc_id: int,
+    ) -> AddedTask:
+        cur = self._db.execute(
+            "INSERT OR IGNORE INTO tasks "
+            "(media_key, file_id, message_id, chat_id, output_path, size, is_thumb, chunk_size, high_priority, dc_id) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                media_key, file_id, message_id, chat_id, str(output_path), size, is_thumb, chunk_size, high_priority,
+                dc_id,
+            ),
+        )
+        if cur.rowcount:
+            self._changed()
+            self.pending += 1
+            self.total_bytes += size
+            self._pending_chats[chat_id] = self._pending_chats.get(chat_id, 0) + 1
+            self._pending_dcs[dc_id] = self._pending_dcs.get(dc_id, 0) + 1
+            return AddedTask(cur.lastrowid, str(output_path), size, False, True)
+
+        # Same media was already added by other message (or by previous run)
+        task_id, output_path, size, state = self._db.execute(
+            "SELECT id, output_path, size, state FROM tasks WHERE media_key = ?", (media_key,),
+        ).fetchone()
+        return AddedTask(
+            task_id, output_path, size, state in (STATE_DONE, STATE_FAILED), False,
+            self._errors.get(task_id) if state == STATE_FAILED else None,
+        )
+
+    def _activate(self, rows: list[tuple]) -> list[StoredTask]:
+        self._db.executemany("UPDATE tasks SET state = ? WHERE id = ?", [(STATE_ACTIVE, row[0]) for row in rows])
+        self._changed(len(rows))
+
+        result = []
+        for row in rows:
+            task = StoredTask(*row)
+            result.append(task)
+            self.pending -= 1
+            self._pending_chats[task.chat_id] -= 1
+            if not self._pending_chats[task.chat_id]:
+                del self._pending_chats[task.chat_id]
+            self._pending_dcs[task.dc_id] -= 1
+            if not self._pending_dcs[task.dc_id]:
+                del self._pending_dcs[task.dc_id]
+
+        return result
+
+    def pending_dcs(self) -> list[int]:
+        return list(self._pending_dcs)
+
+    def has(self, media_key: str) -> bool:
+        return self._db.execute("SELECT 1 FROM tasks WHERE media_key = ?", (media_key,)).fetchone() is not None
+
+    def has_pending_dc(self, dc_id: int) -> bool:
+        return dc_id in self._pending_dcs
+
+    def take(self, limit: int) -> list[StoredTask]:
+        if limit <= 0 or not self.pending:
+            return []
+
+        rows = self._db.execute(
+            f"SELECT {_COLUMNS} FROM tasks WHERE state = ? AND high_priority = 1 ORDER BY id LIMIT ?",
+            (STATE_PENDING, limit),
+        ).fetchall()
+
+        # Rest of working set is split evenly between chats, so round-robin between chats still works
+        #  even if one chat has millions of pending tasks
+        remaining = limit - len(rows)
+        visited = []
+        if remaining > 0 and self._pending_chats:
+            per_chat = max(remaining // len(self._pending_chats), 1)
+            for chat_id in list(self._pending_chats):
+                if remaining <= 0:
+                    break
+                visited.append(chat_id)
+                chat_rows = self._db.execute(
+                    f"SELECT {_COLUMNS} FROM tasks WHERE state = ? AND chat_id = ? AND high_priority = 0 "
+                    f"ORDER BY id LIMIT ?",
+                    (STATE_PENDING, chat_id, min(per_chat, remaining)),
+                ).fetchall()
+                rows.extend(chat_rows)
+                remaining -= len(chat_rows)
+
+        result = self._activate(rows)
+        self.commit()
+
+        # Chats that were served go to the end, so next take starts from other ones
+        for chat_id in visited:
+            if chat_id in self._pending_chats:
+                self._pending_chats[chat_id] = self._pending_chats.pop(chat_id)
+
+        return result
+
+    def take_one(self, task_id: int) -> StoredTask | None:
+        row = self._db.execute(
+            f"SELECT {_COLUMNS} FROM tasks WHERE id = ? AND state = ?", (task_id, STATE_PENDING),
+        ).fetchone()
+        if row is None:
+            return None
+        return self._activate([row])[0]
+
+    def set_high_priority(self, task_id: int, high_priority: bool) -> None:
+        self._db.execute("UPDATE tasks SET high_priority = ? WHERE id = ?", (high_priority, task_id))
+        self._changed()
+
+    def set_file_id(self, task_id: int, file_id: str) -> None:
+        self._db.execute("UPDATE tasks SET file_id = ? WHERE id = ?", (file_id, task_id))
+        self._changed()
+
+    def finish(self, task_id: int, size: int) -> None:
+        self._db.execute("UPDATE tasks SET state = ? WHERE id = ?", (STATE_DONE, task_id))
+        self._changed()
+        self.done_bytes += size
+
+    def fail(self, task_id: int, error: str) -> None:
+        self._errors[task_id] = error
+        self._db.execute("UPDATE tasks SET state = ? WHERE id = ?", (STATE_FAILED, task_id))
+        self._changed()
+
+    def close(self) -> None:
+        self.commit()
+        self._db.close()
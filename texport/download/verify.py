@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import mmap
+import multiprocessing
+import os
+from asyncio import Future, get_running_loop, gather
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from pathlib import Path
+
+from .retry import FailedDownload
+
+MANIFEST_NAME = "SHA256SUMS"
+_READ_SIZE = 4 * 1024 * 1024
+
+
+def verify_file(path: str, size: int) -> tuple[str | None, str | None]:
+    # Runs in worker process. Returns (sha256, None) or (None, error).
+    try:
+        with open(path, "rb") as f:
+            real_size = os.fstat(f.fileno()).st_size
+            if real_size != size:
+                return None, f"Size mismatch: expected {size} bytes, got {real_size}"
+            if not size:
+                return sha256().hexdigest(), None
+
+            digest = sha256()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                for offset in range(0, size, _READ_SIZE):
+                    digest.update(view[offset:offset + _READ_SIZE])
+
+            return digest.hexdigest(), None
+    except OSError as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+class IntegrityVerifier:
+    def __init__(self, output_dir: Path, workers: int | None = None) -> None:
+        # Finished files are hashed in other processes, so hashing does not compete with downloads for GIL
+        self._output_dir = output_dir.absolute()
+        # Workers are not forked from running exporter: fork would copy its event loop, sessions, sqlite connections
+        #  and threads (only forkserver and spawn are available on some platforms anyway)
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self._executor = ProcessPoolExecutor(
+            workers or min(os.cpu_count() or 1, 4), mp_context=multiprocessing.get_context(start_method),
+        )
+        self._loop = get_running_loop()
+        self._pending: set[Future] = set()
+        # Directory (chat directory in output_dir) -> path relative to it -> sha256
+        self._hashes: dict[Path, dict[str, str]] = {}
+
+        self.verified = 0
+        self.failures: list[FailedDownload] = []
+
+    def submit(self, message_id: int, chat_id: int, path: Path, size: int) -> None:
+        future = self._loop.run_in_executor(self._executor, verify_file, str(path), size)
+        self._pending.add(future)
+        future.add_done_callback(lambda f: self._done(f, message_id, chat_id, path, size))
+
+    @property
+    def queue_size(self) -> int:
+        return len(self._pending)
+
+    def _manifest_dir(self, path: Path) -> tuple[Path, str]:
+        path = path.absolute()
+        try:
+            relative = path.relative_to(self._output_dir)
+        except ValueError:
+            return path.parent, path.name
+
+        return self._output_dir / relative.parts[0], Path(*relative.parts[1:]).as_posix()
+
+    def _done(self, future: Future, message_id: int, chat_id: int, path: Path, size: int) -> None:
+        self._pending.discard(future)
+        if future.cancelled():
+            return
+
+        try:
+            digest, error = future.result()
+        except Exception as e:
+            digest, error = None, f"{type(e).__name__}: {e}"
+
+        if error is not None:
+            self.failures.append(FailedDownload(message_id, chat_id, str(path), size, f"Verification failed: {error}"))
+            return
+
+        directory, name = self._manifest_dir(path)
+        self._hashes.setdefault(directory, {})[name] = digest
+        self.verified += 1
+
+    @staticmethod
+    def _write_manifest(directory: Path, hashes: dict[str, str]) -> None:
+        manifest_path = directory / MANIFEST_NAME
+
+        # Files verified in previous runs are kept in manifest
+        existing = {}
+        try:
+            with open(manifest_path, "r", encoding="utf8") as f:
+                for line in f:
+                    digest, sep, name = line.rstrip("\n").partition("  ")
+                    if sep:
+                        existing[name] = digest
+        except OSError:
+            ...
+
+        existing.update(hashes)
+        # Same format as sha256sum output, so manifest can be checked with "sha256sum -c"
+        with open(manifest_path, "w", encoding="utf8") as f:
+            f.writelines(f"{digest}  {name}\n" for name, digest in sorted(existing.items()))
+
+    async def close(self) -> None:
+        if self._pending:
+            await gather(*self._pending, return_exceptions=True)
+
+        for directory, hashes in self._hashes.items():
+            await self._loop.run_in_executor(None, self._write_manifest, directory, hashes)
+
+        self._executor.shutdown()
@@ -30,12 +30,45 @@ class ExportConfig:
     from_date: datetime = datetime(1970, 1, 1)
     to_date: datetime = datetime.now()
     preload: bool = True
+    # Preloading of chat is paused when this many messages are waiting to be exported
+    preload_high_watermark: int = 5000
+    # and resumed when there are this many messages left
+    preload_low_watermark: int = 2500
     max_concurrent_downloads: int = 4
+    media_sessions_per_dc: int = 2
+    # 0 disables adaptive concurrency, otherwise it is upper limit of concurrent downloads
+    max_adaptive_downloads: int = 0
+    coalesce_writes: bool = False
+    download_memory_limit: int = 64  # In megabytes
+    # Maximum number of download tasks kept in memory, the rest of the queue is stored in output_dir
+    download_working_set: int = 1000
+    bandwidth_limit: int = 0  # In kilobytes per second, 0 is unlimited
+    # Dc id -> bandwidth limit for downloads from this dc, in kilobytes per second
+    dc_bandwidth_limits: dict[int, int] = field(default_factory=dict)
+    # Failed requests after which media file is given up on and listed in failed_media.json
+    max_download_errors: int = 10
+    # Hash finished media files and write SHA256SUMS manifest to every chat directory
+    verify_media: bool = False
+    # Directory shared between exports, downloaded media is linked from it instead of being downloaded again
+    media_cache_dir: Path | None = None
+    media_cache_limit: int = 10240  # In megabytes, 0 is unlimited
+    # Number of message id ranges of one chat that are fetched concurrently
+    history_shards: int = 4
+    # Number of history pages of one chat that are requested ahead of messages being exported
+    history_read_ahead: int = 8
+    # Number of chats that are exported at the same time
+    concurrent_chats: int = 4
+    # Maximum number of history requests in flight, shared by all chats
+    max_history_requests: int = 8
+    # Export only messages newer than ones exported by previous run and append them to existing output
+    incremental: bool = False
     use_takeout_api: bool = False
     count_messages: bool = True
     write_threshold: int = 1000
     partial_writes: bool = True
     formats: list[str] = field(default_factory=list)
+    # Chat id (as in chat_ids) -> share of media downloads relative to other chats, 1 by default
+    chat_weights: dict[str | int, int] = field(default_factory=dict)
 
     def excluded_media(self) -> set[MessageMediaType]:
         result = set()
@@ -47,5 +80,31 @@ class ExportConfig:
     def __post_init__(self):
         if self.max_concurrent_downloads <= 0:
             self.max_concurrent_downloads = 4
+        if self.media_sessions_per_dc <= 0:
+            self.media_sessions_per_dc = 1
+        if self.download_memory_limit <= 0:
+            self.download_memory_limit = 64
+        if self.download_working_set <= 0:
+            self.download_working_set = 1000
+        if self.max_download_errors <= 0:
+            self.max_download_errors = 10
+        if self.media_cache_limit < 0:
+            self.media_cache_limit = 0
+        if self.preload_high_watermark <= 0:
+            self.preload_high_watermark = 5000
+        if not 0 <= self.preload_low_watermark < self.preload_high_watermark:
+            self.preload_low_watermark = self.preload_high_watermark // 2
+        if self.history_shards <= 0:
+            self.history_shards = 1
+        if self.history_read_ahead <= 0:
+            self.history_read_ahead = 1
+        if self.concurrent_chats <= 0:
+            self.concurrent_chats = 1
+        if self.max_history_requests <= 0:
+            self.max_history_requests = 8
+        if self.bandwidth_limit < 0:
+            self.bandwidth_limit = 0
+        if self.max_adaptive_downloads < 0:
+            self.max_adaptive_downloads = 0
         self.from_date = self.from_date.replace(tzinfo=UTC)
         self.to_date = self.to_date.replace(tzinfo=UTC)
@@ -3,10 +3,24 @@ from __future__ import annotations
 from asyncio import Event
 
 
+class ChatExportProgress:
+    __slots__ = ("status", "approx_messages_count", "messages_exported", "finished",)
+
+    def __init__(self, progress: ChatExportProgress | None = None) -> None:
+        self.status = progress.status if progress is not None else "Waiting..."
+        self.approx_messages_count = progress.approx_messages_count if progress is not None else 0
+        self.messages_exported = progress.messages_exported if progress is not None else 0
+        self.finished = progress.finished if progress is not None else False
+
+
 class ExportProgress:
     __slots__ = (
         "status", "approx_messages_count", "messages_exported", "messages_loaded", "media_status", "media_queue",
-        "media_bytes", "media_down_bytes", "media_fail_bytes", "changed",
+        "media_bytes", "media_down_bytes", "media_fail_bytes", "media_sessions",
+        "media_concurrency", "media_concurrency_history", "media_buffered_bytes", "media_buffered_peak",
+        "media_bandwidth_limit", "media_throttled_time", "media_paused_dcs",
+        "media_verified", "media_verify_queue", "media_cache_hits", "media_cache_misses", "chats", "preload_queue", "preload_blocked_time",
+        "changed",
     )
 
     def __init__(self, progress: ExportProgress | None = None) -> None:
@@ -18,6 +32,26 @@ class ExportProgress:
         self.media_queue = progress.media_queue if progress is not None else 0
         self.media_bytes = progress.media_bytes if progress is not None else 0
         self.media_down_bytes = progress.media_down_bytes if progress is not None else 0
+        self.media_fail_bytes = progress.media_fail_bytes if progress is not None else 0
+        self.media_sessions: dict[int, list[int]] = dict(progress.media_sessions) if progress is not None else {}
+        self.media_concurrency = progress.media_concurrency if progress is not None else 0
+        self.media_concurrency_history: list[int] = \
+            list(progress.media_concurrency_history) if progress is not None else []
+        self.media_buffered_bytes = progress.media_buffered_bytes if progress is not None else 0
+        self.media_buffered_peak = progress.media_buffered_peak if progress is not None else 0
+        self.media_bandwidth_limit = progress.media_bandwidth_limit if progress is not None else 0
+        self.media_throttled_time = progress.media_throttled_time if progress is not None else 0.0
+        self.media_paused_dcs: list[int] = list(progress.media_paused_dcs) if progress is not None else []
+        self.media_verified = progress.media_verified if progress is not None else 0
+        self.media_verify_queue = progress.media_verify_queue if progress is not None else 0
+        self.media_cache_hits = progress.media_cache_hits if progress is not None else 0
+        self.media_cache_misses = progress.media_cache_misses if progress is not None else 0
+        self.preload_queue = progress.preload_queue if progress is not None else 0
+        self.preload_blocked_time = progress.preload_blocked_time if progress is not None else 0.0
+        # Chat id (as in config) -> progress of this chat
+        self.chats: dict[int | str, ChatExportProgress] = {
+            chat_id: ChatExportProgress(chat_progress) for chat_id, chat_progress in progress.chats.items()
+        } if progress is not None else {}
 
 
 class ExportProgressInternal(ExportProgress):
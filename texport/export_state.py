@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+
+EXPORT_STATE_FILE = ".texport-state.json"
+
+
+class ExportState:
+    __slots__ = ("path", "_chats",)
+
+    def __init__(self, path: Path) -> None:
+        # Incremental export state: for every chat id, id of last exported message and state of every format saver,
+        #  so next run fetches only newer messages and appends them to existing output.
+        self.path = path
+        self._chats: dict[str, dict] = {}
+
+        try:
+            with open(self.path, "r", encoding="utf8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if isinstance(state, dict) and isinstance(state.get("chats"), dict):
+            self._chats = state["chats"]
+
+    def last_message_id(self, chat_id: int) -> int:
+        return self._chats.get(str(chat_id), {}).get("last_message_id", 0)
+
+    def saver_state(self, chat_id: int, format_name: str) -> dict | None:
+        return self._chats.get(str(chat_id), {}).get("formats", {}).get(format_name)
+
+    def set(self, chat_id: int, last_message_id: int, formats: dict[str, dict]) -> None:
+        self._chats[str(chat_id)] = {
+            "last_message_id": last_message_id,
+            "formats": formats,
+        }
+        self._save()
+
+    def _save(self) -> None:
+        # State is only written after all messages of chat are written, and is replaced atomically,
+        #  so export that was interrupted is continued from previous state
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump({"chats": self._chats}, f)
+        os.replace(tmp_path, self.path)
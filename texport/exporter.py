@@ -1,35 +1,26 @@
 import asyncio
-from asyncio import sleep, Task
+from asyncio import Task, gather
+from collections import deque
 from time import time
-from typing import TypeVar, Callable, ParamSpec, Awaitable, cast
+from typing import Callable, Awaitable, cast
 
 from pyrogram import Client
-from pyrogram.errors import FloodWait, PeerIdInvalid
+from pyrogram.errors import PeerIdInvalid
 from pyrogram.raw.base import InputPeer
 from pyrogram.raw.functions.account import InitTakeoutSession
-from pyrogram.raw.functions.messages import GetHistory
 from pyrogram.raw.types import InputChannel, InputUser
-from pyrogram.raw.types.messages import Messages, MessagesSlice
+from pyrogram.raw.types.messages import Messages
 from pyrogram.types import Message as PyroMessage
+from pyrogram.utils import get_peer_id
 
 from . import ExportConfig, MediaExporter, Preloader, ExportProgress
-from .download.downloader import DownloadTask
-from .export_progress import ExportProgressInternal
+from .download.downloader import DownloadHandle
+from .export_progress import ExportProgressInternal, ChatExportProgress
+from .export_state import ExportState, EXPORT_STATE_FILE
+from .history import HistoryFetcher
 from .media import MEDIA_TYPES, ExpiredMedia
 from .messages_saver import MessageToSave, MessageSaverBase
 
-T = TypeVar("T")
-P = ParamSpec("P")
-
-
-async def _flood_wait(func: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T | None:
-    for i in range(5):
-        try:
-            return await func(*args, **kwargs)
-        except FloodWait as e:
-            await sleep(e.value + 1)
-
-
 ProgressCallback = Callable[[ExportProgress], Awaitable]
 
 
@@ -42,8 +33,12 @@ class Exporter:
         self._progress = ExportProgressInternal()
         self._media_downloader = MediaExporter(client, export_config, self._progress)
         self._excluded_media = self._config.excluded_media()
+        self._state = ExportState(self._config.output_dir / EXPORT_STATE_FILE) if self._config.incremental else None
+        self._history = HistoryFetcher(
+            client, self._config.history_shards, max_requests=self._config.max_history_requests,
+            read_ahead=self._config.history_read_ahead,
+        )
         self._loop = asyncio.get_running_loop()
-        self._write_tasks: set[Task] = set()
 
         self._progress_callbacks: set[ProgressCallback] = set()
 
@@ -54,15 +49,24 @@ class Exporter:
     def remove_progress_callback(self, func: ProgressCallback) -> None:
         self._progress_callbacks.add(func)
 
-    def _add_downloader_task(self, message_id: int, media: ..., out_dir: str, is_thumb: bool) -> DownloadTask | None:
+    def set_bandwidth_limit(self, limit: int, dc_id: int | None = None) -> None:
+        # Limit is in kilobytes per second, 0 removes limit. Can be changed while export is running.
+        self._media_downloader.set_bandwidth_limit(limit, dc_id)
+
+    async def _add_downloader_task(
+            self, message: PyroMessage, media: ..., out_dir: str, is_thumb: bool,
+    ) -> DownloadHandle | None:
         if media is None:
             return None
 
         mime = getattr(media, "mime_type", None)
-        date = getattr(media, "date", None)
-        return self._media_downloader.add(media.file_id, out_dir, message_id, is_thumb, media.file_size, mime, date)
+        # Message date is used as fallback so file names are the same across runs and downloads can be resumed
+        date = getattr(media, "date", None) or message.date
+        return await self._media_downloader.add(
+            media.file_id, out_dir, message.id, is_thumb, media.file_size, mime, date, message.chat.id,
+        )
 
-    async def _export_media(self, message: PyroMessage) -> tuple[DownloadTask | None, DownloadTask | None]:
+    async def _export_media(self, message: PyroMessage) -> tuple[DownloadHandle | None, DownloadHandle | None]:
         if message.media not in MEDIA_TYPES or message.media in self._excluded_media:
             return None, None
 
@@ -78,12 +82,14 @@ class Exporter:
 
         chat_output_dir = (self._config.output_dir / f"{message.chat.id}").absolute()
 
-        media_task = self._add_downloader_task(message.id, media, f"{chat_output_dir}/{m.dir_name}/", False)
-        thumb_task = self._add_downloader_task(message.id, thumb, f"{chat_output_dir}/thumbs/", True)
+        media_task = await self._add_downloader_task(message, media, f"{chat_output_dir}/{m.dir_name}/", False)
+        thumb_task = await self._add_downloader_task(message, thumb, f"{chat_output_dir}/thumbs/", True)
 
         return media_task, thumb_task
 
-    def _enqueue_save(self, savers: list[MessageSaverBase], message: MessageToSave | None) -> None:
+    def _enqueue_save(
+            self, savers: list[MessageSaverBase], message: MessageToSave | None, write_tasks: set[Task],
+    ) -> None:
         tasks = []
 
         for saver in savers:
@@ -96,37 +102,22 @@ class Exporter:
                 tasks.append(task)
 
         for task in tasks:
-            self._write_tasks.update(tasks)
-            task.add_done_callback(self._write_tasks.remove)
+            write_tasks.add(task)
+            task.add_done_callback(write_tasks.discard)
 
         if tasks:
             self._progress.status = "Writing messages to file..."
             self._progress.changed()
 
-    async def _get_history(
-            self, peer: InputPeer | InputUser | InputChannel, offset_date: int, offset_id: int, limit: int, min_id: int,
-    ) -> Messages | MessagesSlice:
-        return await self._client.invoke(GetHistory(
-            peer=peer,
-            offset_date=offset_date,
-            offset_id=offset_id,
-            add_offset=0,
-            limit=limit,
-            max_id=0,
-            min_id=min_id,
-            hash=0,
-        ))
-
-    async def _get_min_max_ids(self, chat_id: int | str) -> tuple[int, int]:
+    async def _get_min_max_ids(self, peer: InputPeer | InputUser | InputChannel) -> tuple[int, int]:
         from_date = int(self._config.from_date.timestamp())
         to_date = int(self._config.to_date.timestamp())
 
         date_offset_min = (from_date - 1) if from_date > 0 else 1
         date_offset_max = (to_date + 86400) if to_date < time() else int(time())
 
-        peer = await self._client.resolve_peer(chat_id)
-        min_messages = await self._get_history(peer, date_offset_min, 0, 1, 0)
-        max_messages = await self._get_history(peer, date_offset_max, 0, 1, 0)
+        min_messages = await self._history.get_history(peer, limit=1, offset_date=date_offset_min)
+        max_messages = await self._history.get_history(peer, limit=1, offset_date=date_offset_max)
 
         min_messages = cast(list[PyroMessage], min_messages.messages)
         max_messages = cast(list[PyroMessage], max_messages.messages)
@@ -160,113 +151,167 @@ class Exporter:
 
         raise PeerIdInvalid
 
-    async def _export(self):
-        if self._config.use_takeout_api and not await self._client.storage.is_bot() and not self._client.takeout_id:
-            self._client.takeout_id = (await self._client.invoke(InitTakeoutSession(
-                message_users=True,
-                message_chats=True,
-                message_megagroups=True,
-                message_channels=True,
-                files=True,
-                file_max_size=1024 * 1024 * 1024 * 4,
-            ))).id
-
-        if not self._config.formats:
-            raise ValueError("Expected at least one format to be exported.")
-
-        savers = [
+    def _new_savers(self) -> list[MessageSaverBase]:
+        return [
             MessageSaverBase.new_by_format(fmt, self._config)
             for fmt in self._config.formats
         ]
 
-        await self._media_downloader.run()
+    async def _chat_worker(self, chat_ids: deque[int | str]) -> None:
+        while chat_ids:
+            await self._export_chat(chat_ids.popleft())
 
-        self._progress.start()
-        self._progress_task = self._loop.create_task(self._progress_func())
-
-        loaded = 0
-        chat_ids = []
-
-        message_ranges: dict[int | str, tuple[int, int]] = {}
-        counts: dict[int | str, int] = {}
-        for chat_id in self._config.chat_ids:
-            chat_id = await self._try_fix_peer_id(chat_id)
-            chat_ids.append(chat_id)
+    async def _export_chat(self, config_chat_id: int | str) -> None:
+        chat_progress = self._progress.chats[config_chat_id]
+        chat_progress.status = "Counting messages..."
+        self._progress.changed()
 
-            message_ranges[chat_id] = await self._get_min_max_ids(chat_id)
-            min_id, max_id = message_ranges[chat_id]
-            id_diff = (max_id - min_id) if min_id > 0 and max_id > 0 else (2 ** 31 - 1)
+        weight = self._config.chat_weights.get(config_chat_id)
+        chat_id = await self._try_fix_peer_id(config_chat_id)
+        peer = await self._client.resolve_peer(chat_id)
 
-            if not self._config.count_messages:
-                continue
+        peer_id = get_peer_id(peer)
+        if weight is not None:
+            self._media_downloader.set_chat_weight(peer_id, weight)
+
+        savers = self._new_savers()
+        min_id, max_id = await self._get_min_max_ids(peer)
+
+        last_message_id = 0
+        if self._state is not None and (last_message_id := self._state.last_message_id(peer_id)):
+            if all(
+                    saver.load_state(peer_id, self._state.saver_state(peer_id, fmt.lower()) or {})
+                    for fmt, saver in zip(self._config.formats, savers)
+            ):
+                # Only messages newer than ones exported by previous run are fetched
+                min_id = max(min_id, last_message_id)
+            else:
+                # Output of previous run was changed or removed, so chat is exported from scratch
+                for saver in savers:
+                    saver.close()
+                savers = self._new_savers()
+                last_message_id = 0
+
+        if max_id and max_id - 1 <= min_id:
+            for saver in savers:
+                saver.close()
+            chat_progress.status = "No new messages"
+            chat_progress.finished = True
+            self._progress.changed()
+            return
 
-            resp = await _flood_wait(
-                self._get_history,
-                peer=await self._client.resolve_peer(chat_id),
-                offset_date=0,
-                offset_id=max_id,
-                limit=1,
-                min_id=min_id,
-            )
+        id_diff = (max_id - min_id) if min_id > 0 and max_id > 0 else (2 ** 31 - 1)
 
-            if resp is None:
-                count = 0
-            elif isinstance(resp, Messages):
+        count = 0
+        if self._config.count_messages:
+            resp = await self._history.get_history(peer, offset_id=max_id, min_id=min_id, limit=1)
+            if isinstance(resp, Messages):
                 count = min(len(resp.messages), id_diff)
             else:
                 count = min(resp.count, id_diff)
 
-            counts[chat_id] = count
+            chat_progress.approx_messages_count = count
             self._progress.approx_messages_count += count
             self._progress.changed()
 
+        write_tasks: set[Task] = set()
+
         if self._config.preload:
-            messages_iter = Preloader(self._client, self._progress, chat_ids, self._export_media)
+            messages_iter = Preloader(
+                self._client, self._progress, [chat_id], self._export_media, self._history,
+                self._config.preload_high_watermark, self._config.preload_low_watermark,
+            )
         else:
-            messages_iter = self._client.get_chat_history
+            messages_iter = self._history
+
+        chat_progress.status = "Exporting messages..."
+        exported = 0
+        message: MessageToSave | PyroMessage
+        async for message in messages_iter(chat_id, min_id=min_id, max_id=max_id):
+            message_to_save: MessageToSave
+            if not self._config.preload:
+                message_to_save = MessageToSave(message, None, None)
+            else:
+                message_to_save = message
+                message = message.message
 
-        for chat_id, (min_id, max_id) in message_ranges.items():
-            loaded_start = loaded
-            message: MessageToSave | PyroMessage
-            async for message in messages_iter(chat_id, min_id=min_id, max_id=max_id):
-                message_to_save: MessageToSave
-                if not self._config.preload:
-                    message_to_save = MessageToSave(message, None, None)
-                else:
-                    message_to_save = message
-                    message = message.message
+            exported += 1
+            last_message_id = max(last_message_id, message.id)
+            chat_progress.messages_exported = exported
+            self._progress.messages_exported += 1
+            self._progress.changed()
 
-                loaded += 1
-                self._progress.status = "Exporting messages..."
-                self._progress.messages_exported = loaded
-                self._progress.changed()
+            if not message.text and not message.caption and message.media not in MEDIA_TYPES:
+                continue
 
-                if not message.text and not message.caption and message.media not in MEDIA_TYPES:
-                    continue
+            if message.media and not self._config.preload:
+                message_to_save.media_task, message_to_save.thumb_task = await self._export_media(message)
 
-                if message.media and not self._config.preload:
-                    message_to_save.media_task, message_to_save.thumb_task = await self._export_media(message)
+            self._enqueue_save(savers, message_to_save, write_tasks)
 
-                self._enqueue_save(savers, message_to_save)
+        self._enqueue_save(savers, None, write_tasks)
+
+        chat_progress.status = "Writing messages to file..."
+        self._progress.changed()
+        if write_tasks:
+            await gather(*write_tasks)
+        for saver in savers:
+            await saver.finish()
+            saver.close()
+
+        if self._state is not None:
+            self._state.set(peer_id, last_message_id, {
+                fmt.lower(): saver.get_state(peer_id)
+                for fmt, saver in zip(self._config.formats, savers)
+            })
+
+        if self._config.count_messages:
+            self._progress.approx_messages_count += exported - count
+        chat_progress.approx_messages_count = exported
+        chat_progress.status = "Done!"
+        chat_progress.finished = True
+        self._progress.changed()
+
+    async def _export(self):
+        if self._config.use_takeout_api and not await self._client.storage.is_bot() and not self._client.takeout_id:
+            self._client.takeout_id = (await self._client.invoke(InitTakeoutSession(
+                message_users=True,
+                message_chats=True,
+                message_megagroups=True,
+                message_channels=True,
+                files=True,
+                file_max_size=1024 * 1024 * 1024 * 4,
+            ))).id
 
-            self._enqueue_save(savers, None)
+        if not self._config.formats:
+            raise ValueError("Expected at least one format to be exported.")
 
-            if chat_id in counts:
-                old_count = counts[chat_id]
-                real_count = loaded - loaded_start
-                self._progress.approx_messages_count -= old_count
-                self._progress.approx_messages_count += real_count
-                self._progress.changed()
+        await self._media_downloader.run()
 
-                counts[chat_id] = real_count
+        self._progress.start()
+        self._progress_task = self._loop.create_task(self._progress_func())
 
-        self._progress.status = "Waiting for all messages to be saved..."
+        chat_ids = deque(self._config.chat_ids)
+        for chat_id in chat_ids:
+            self._progress.chats[chat_id] = ChatExportProgress()
+        self._progress.status = "Exporting messages..."
         self._progress.changed()
 
-        while self._write_tasks:
-            await sleep(0)
+        # Every chat has its own history fetching, savers and preloader, chats only share media downloader
+        #  and history requests limit
+        workers = [
+            self._loop.create_task(self._chat_worker(chat_ids))
+            for _ in range(min(self._config.concurrent_chats, len(chat_ids)))
+        ]
+        try:
+            await gather(*workers)
+        except BaseException:
+            for worker in workers:
+                worker.cancel()
+            raise
 
         self._task = None
+        await self._history.close()
 
         self._progress.status = "Stopping media downloader..."
         self._progress.changed()
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+from asyncio import sleep, Event, Task, Semaphore, Lock, get_running_loop
+from collections import deque
+from time import time
+from typing import AsyncIterator
+
+from pyrogram import Client, utils
+from pyrogram.errors import FloodWait
+from pyrogram.raw.base import InputPeer
+from pyrogram.raw.functions import InvokeWithTakeout
+from pyrogram.raw.functions.messages import GetHistory
+from pyrogram.raw.types.messages import Messages, MessagesSlice, ChannelMessages
+from pyrogram.session import Session
+from pyrogram.types import Message
+
+from .download.session_pool import FloodWaitClient
+
+PAGE_SIZE = 100
+
+
+class _Shard:
+    __slots__ = ("min_id", "max_id", "pages", "count", "error", "done", "changed",)
+
+    def __init__(self, min_id: int, max_id: int) -> None:
+        # Ids are exclusive on both ends, same as in GetHistory
+        self.min_id = min_id
+        self.max_id = max_id
+        # Pages are yielded as soon as they are fetched, consumer does not wait for whole shard
+        self.pages: deque[list[Message]] = deque()
+        self.count = 0
+        self.error: BaseException | None = None
+        self.done = False
+        self.changed = Event()
+
+
+class _Planner:
+    __slots__ = (
+        "min_id", "max_id", "target", "shards", "finished", "changed", "_ids", "_count", "_max_span",
+        "head", "_read_ahead", "_ahead", "_released",
+    )
+
+    def __init__(self, min_id: int, max_id: int, target: int, read_ahead: int) -> None:
+        self.min_id = min_id
+        self.max_id = max_id
+        # Number of messages one shard should have
+        self.target = target
+        self.shards: list[_Shard] = []
+        self.finished = False
+        self.changed = Event()
+        self._ids = 0
+        self._count = 0
+        self._max_span = 0
+        # Index of shard that is being consumed
+        self.head = 0
+        # Pages that are requested or fetched, but not yet taken by consumer
+        self._read_ahead = read_ahead
+        self._ahead = 0
+        self._released = Event()
+
+    def next(self) -> _Shard | None:
+        if self.max_id - 1 <= self.min_id:
+            self.finished = True
+            self.changed.set()
+            return None
+
+        if not self._ids:
+            span = self.target
+        else:
+            # Shards grow quickly in empty parts of history, but not to infinity, in case there is just big gap
+            span = int(self.target * self._ids / max(self._count, 1))
+            span = min(max(span, PAGE_SIZE), self._max_span * 8)
+
+        shard = _Shard(max(self.max_id - span, self.min_id), self.max_id)
+        # Both bounds are exclusive, so message with id equal to shard.min_id belongs to next shard
+        self.max_id = shard.min_id + 1
+        self.shards.append(shard)
+        self.changed.set()
+        return shard
+
+    def measured(self, shard: _Shard) -> None:
+        span = shard.max_id - shard.min_id - 1
+        self._ids += span
+        self._count += shard.count
+        self._max_span = max(self._max_span, span)
+
+    async def reserve(self, shard: _Shard) -> None:
+        # Shard that consumer waits for is never blocked by pages of later shards
+        while self._ahead >= self._read_ahead and shard is not self.shards[self.head]:
+            self._released.clear()
+            await self._released.wait()
+        self._ahead += 1
+
+    def release(self) -> None:
+        self._ahead -= 1
+        self._released.set()
+
+    def advance(self) -> None:
+        self.head += 1
+        self._released.set()
+
+
+class HistoryFetcher:
+    def __init__(
+            self, client: Client, shards: int = 4, shard_pages: int = 4, max_requests: int = 8, read_ahead: int = 8,
+    ) -> None:
+        # Message id range is split into shards that are fetched concurrently and yielded in order (newest first).
+        #  Shard size follows message density (ids in private chats and basic groups are shared by all chats
+        #  of account, so they are sparse), so each shard takes about "shard_pages" requests.
+        self._client = client
+        self._shards = max(shards, 1)
+        self._shard_pages = max(shard_pages, 1)
+        # Pages of one chat that are requested or fetched ahead of consumer, so it never waits for next page
+        #  while messages of current one are processed
+        self._read_ahead = max(read_ahead, 1)
+        # Fetcher is shared by all chats that are exported concurrently, so both limit of requests in flight
+        #  and FloodWait apply to all of them, not only to the one that got it
+        self._requests = Semaphore(max(max_requests, 1))
+        self._flood_until = 0.0
+        # Client's own session sleeps through short flood waits while holding request slot, so history is
+        #  requested through separate session to home dc that raises all of them
+        self._session: Session | None = None
+        self._session_lock = Lock()
+
+    def __call__(self, chat_id: int | str, min_id: int = 0, max_id: int = 0) -> AsyncIterator[Message]:
+        return self._iter(chat_id, min_id, max_id)
+
+    async def get_history(
+            self, peer: InputPeer, offset_id: int = 0, min_id: int = 0, limit: int = PAGE_SIZE, offset_date: int = 0,
+    ) -> Messages | MessagesSlice | ChannelMessages:
+        while True:
+            if (wait := self._flood_until - time()) > 0:
+                await sleep(wait)
+
+            async with self._requests:
+                if self._flood_until > time():
+                    continue
+
+                try:
+                    return await self._invoke(GetHistory(
+                        peer=peer,
+                        offset_id=offset_id,
+                        offset_date=offset_date,
+                        add_offset=0,
+                        limit=limit,
+                        max_id=0,
+                        min_id=min_id,
+                        hash=0,
+                    ))
+                except FloodWait as e:
+                    self._flood_until = max(self._flood_until, time() + e.value + 1)
+
+    async def _get_session(self) -> Session:
+        async with self._session_lock:
+            if self._session is None:
+                storage = self._client.storage
+                session = Session(
+                    FloodWaitClient(self._client), await storage.dc_id(), await storage.auth_key(),
+                    await storage.test_mode(), is_media=True,
+                )
+                await session.start()
+                self._session = session
+
+        return self._session
+
+    async def _invoke(self, query: GetHistory) -> Messages | MessagesSlice | ChannelMessages:
+        # Same as Client.invoke, but through session that does not sleep on flood waits
+        if self._client.takeout_id:
+            query = InvokeWithTakeout(takeout_id=self._client.takeout_id, query=query)
+
+        response = await (await self._get_session()).invoke(query, sleep_threshold=0)
+        await self._client.fetch_peers(getattr(response, "users", []))
+        await self._client.fetch_peers(getattr(response, "chats", []))
+        return response
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.stop()
+            self._session = None
+
+    async def _fetch(self, peer: InputPeer, planner: _Planner, shard: _Shard) -> None:
+        offset_id = shard.max_id
+        while offset_id - 1 > shard.min_id:
+            await planner.reserve(shard)
+            try:
+                response = await self.get_history(peer, offset_id, shard.min_id)
+                messages = await utils.parse_messages(self._client, response, replies=0)
+            except BaseException:
+                planner.release()
+                raise
+
+            if not response.messages:
+                planner.release()
+                break
+
+            shard.pages.append(messages)
+            shard.count += len(messages)
+            shard.changed.set()
+            offset_id = response.messages[-1].id
+
+    async def _worker(self, peer: InputPeer, planner: _Planner) -> None:
+        while (shard := planner.next()) is not None:
+            try:
+                await self._fetch(peer, planner, shard)
+            except Exception as e:
+                shard.error = e
+            planner.measured(shard)
+            shard.done = True
+            shard.changed.set()
+
+    async def _top_id(self, peer: InputPeer) -> int:
+        response = await self.get_history(peer, limit=1)
+        return (response.messages[0].id + 1) if response.messages else 0
+
+    async def _iter(self, chat_id: int | str, min_id: int, max_id: int) -> AsyncIterator[Message]:
+        peer = await self._client.resolve_peer(chat_id)
+        if not max_id and not (max_id := await self._top_id(peer)):
+            return
+
+        planner = _Planner(min_id, max_id, PAGE_SIZE * self._shard_pages, self._read_ahead)
+        loop = get_running_loop()
+        workers: list[Task] = [
+            loop.create_task(self._worker(peer, planner))
+            for _ in range(self._shards)
+        ]
+
+        try:
+            while True:
+                if planner.head == len(planner.shards):
+                    if planner.finished:
+                        return
+                    planner.changed.clear()
+                    await planner.changed.wait()
+                    continue
+
+                shard = planner.shards[planner.head]
+                while shard.pages or not shard.done:
+                    if not shard.pages:
+                        shard.changed.clear()
+                        await shard.changed.wait()
+                        continue
+
+                    messages = shard.pages.popleft()
+                    planner.release()
+                    for message in messages:
+                        yield message
+
+                if shard.error is not None:
+                    raise shard.error
+                planner.advance()
+        finally:
+            for worker in workers:
+                worker.cancel()
@@ -61,8 +61,45 @@ _supported_formats = ", ".join(f"\"{fmt}\"" for fmt in MessageSaverBase.register
 @click.option("--documents/--no-documents", default=True, help="Download documents or not.")
 @click.option("--quiet", "-q", is_flag=True, default=False, help="Do not print progress to console.")
 @click.option("--no-preload", is_flag=True, default=False, help="Do not preload all messages.")
+@click.option("--preload-high-watermark", type=click.INT, default=5000,
+              help="Number of preloaded messages of chat after which preloading is paused.")
+@click.option("--preload-low-watermark", type=click.INT, default=2500,
+              help="Number of preloaded messages of chat at which paused preloading is resumed.")
 @click.option("--max-concurrent-downloads", "-d", type=click.INT, default=4,
               help="Number of concurrent media downloads.")
+@click.option("--media-sessions", "-n", type=click.INT, default=2,
+              help="Number of media connections per datacenter.")
+@click.option("--max-adaptive-downloads", type=click.INT, default=0,
+              help="Adjust number of concurrent media downloads automatically, up to this value. "
+                   "\"--max-concurrent-downloads\" is used as initial value. 0 to disable.")
+@click.option("--coalesce-writes", is_flag=True, default=False,
+              help="Write adjacent downloaded chunks of one file with a single system call.")
+@click.option("--download-memory-limit", type=click.INT, default=64,
+              help="Maximum size of downloaded media chunks waiting to be written to disk, in megabytes.")
+@click.option("--download-working-set", type=click.INT, default=1000,
+              help="Maximum number of media downloads kept in memory, the rest of the queue is kept on disk.")
+@click.option("--bandwidth-limit", type=click.INT, default=0,
+              help="Maximum media download speed, in kilobytes per second. 0 means unlimited.")
+@click.option("--dc-bandwidth-limit", "dc_bandwidth_limits", type=click.STRING, default=[], multiple=True,
+              help="Maximum media download speed from specific dc, in \"<dc id>=<kilobytes per second>\" format.")
+@click.option("--max-download-errors", type=click.INT, default=10,
+              help="Failed requests after which media file is skipped and listed in failed_media.json.")
+@click.option("--verify-media", is_flag=True, default=False,
+              help="Verify downloaded media and write SHA256SUMS file to every chat directory.")
+@click.option("--media-cache", type=click.STRING, default=None,
+              help="Directory with media cache shared between exports. Disabled by default.")
+@click.option("--media-cache-limit", type=click.INT, default=10240,
+              help="Maximum size of media cache, in megabytes. 0 means unlimited.")
+@click.option("--history-shards", type=click.INT, default=4,
+              help="Number of parts of chat history that are fetched concurrently.")
+@click.option("--history-read-ahead", type=click.INT, default=8,
+              help="Number of history pages of chat that are requested ahead of messages being exported.")
+@click.option("--concurrent-chats", type=click.INT, default=4,
+              help="Number of chats that are exported at the same time.")
+@click.option("--max-history-requests", type=click.INT, default=8,
+              help="Maximum number of history requests in flight, shared by all chats.")
+@click.option("--incremental", is_flag=True, default=False,
+              help="Export only messages that are newer than ones exported to output directory before.")
 @click.option("--takeout", is_flag=True, default=False, help="Use takeout api.")
 @click.option("--no-count", is_flag=True, default=False, help="Do not count messages that will be exported.")
 @click.option("--write-threshold", "-w", type=click.INT, default=1000, help="Messages write threshold.")
@@ -70,16 +107,39 @@ _supported_formats = ", ".join(f"\"{fmt}\"" for fmt in MessageSaverBase.register
               help="Write messages after waiting for ALL media to download.")
 @click.option("--format", "-m", "formats", type=click.STRING, default=["html"], multiple=True,
               help=f"Export format. Supported formats: {_supported_formats}")
+@click.option("--chat-weight", "chat_weights", type=click.STRING, default=[], multiple=True,
+              help="Share of media downloads for chat relative to other chats, in \"<chat id>=<weight>\" format.")
 def main(
         session_name: str, api_id: int, api_hash: str, chat_id: list[str], output: str, size_limit: int, from_date: str,
         to_date: str, photos: bool, videos: bool, voice: bool, video_notes: bool, stickers: bool, gifs: bool,
-        documents: bool, quiet: bool, no_preload: bool, max_concurrent_downloads: int, takeout: bool, no_count: bool,
-        write_threshold: int, all_media_wait: bool, formats: list[str],
+        documents: bool, quiet: bool, no_preload: bool, preload_high_watermark: int, preload_low_watermark: int,
+        max_concurrent_downloads: int, media_sessions: int, max_adaptive_downloads: int, coalesce_writes: bool,
+        download_memory_limit: int, download_working_set: int, bandwidth_limit: int, dc_bandwidth_limits: list[str],
+        max_download_errors: int, verify_media: bool, media_cache: str | None, media_cache_limit: int,
+        history_shards: int, history_read_ahead: int, concurrent_chats: int, max_history_requests: int,
+        incremental: bool, takeout: bool, no_count: bool, write_threshold: int, all_media_wait: bool,
+        formats: list[str], chat_weights: list[str],
 ) -> int:
     if not formats:
         print(f"No formats were provided, expected at least one of {_supported_formats}")
         return 1
 
+    weights = {}
+    for chat_weight in chat_weights:
+        weight_chat_id, _, weight = chat_weight.rpartition("=")
+        if not weight_chat_id or not weight.isdigit():
+            print(f"Invalid chat weight \"{chat_weight}\", expected \"<chat id>=<weight>\"")
+            return 1
+        weights[weight_chat_id] = int(weight)
+
+    dc_limits = {}
+    for dc_limit in dc_bandwidth_limits:
+        dc_id, _, limit = dc_limit.partition("=")
+        if not dc_id.isdigit() or not limit.isdigit():
+            print(f"Invalid dc bandwidth limit \"{dc_limit}\", expected \"<dc id>=<kilobytes per second>\"")
+            return 1
+        dc_limits[int(dc_id)] = int(limit)
+
     home = Path.home()
     texport_dir = home / ".texport"
     makedirs(texport_dir, exist_ok=True)
@@ -99,12 +159,31 @@ def main(
         export_gifs=gifs,
         export_files=documents,
         preload=not no_preload,
+        preload_high_watermark=preload_high_watermark,
+        preload_low_watermark=preload_low_watermark,
         max_concurrent_downloads=max_concurrent_downloads,
+        media_sessions_per_dc=media_sessions,
+        max_adaptive_downloads=max_adaptive_downloads,
+        coalesce_writes=coalesce_writes,
+        download_memory_limit=download_memory_limit,
+        download_working_set=download_working_set,
+        bandwidth_limit=bandwidth_limit,
+        dc_bandwidth_limits=dc_limits,
+        max_download_errors=max_download_errors,
+        verify_media=verify_media,
+        media_cache_dir=Path(media_cache) if media_cache else None,
+        media_cache_limit=media_cache_limit,
+        history_shards=history_shards,
+        history_read_ahead=history_read_ahead,
+        concurrent_chats=concurrent_chats,
+        max_history_requests=max_history_requests,
+        incremental=incremental,
         use_takeout_api=takeout,
         count_messages=not no_count,
         write_threshold=write_threshold,
         partial_writes=not all_media_wait,
         formats=formats,
+        chat_weights=weights,
     )
 
     if session_name.endswith(".session"):
@@ -1,16 +1,25 @@
-from asyncio import sleep, get_running_loop
+import json
+from asyncio import get_running_loop
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, UTC
 from pathlib import Path
 
 from pyrogram import Client
 from pyrogram.file_id import PHOTO_TYPES, FileType, FileId
 
-from .download.downloader import Downloader, DownloadTask
+from .download.downloader import Downloader, DownloadHandle, DownloadTask, get_media_key
+from .download.media_cache import MediaCache
+from .download.retry import RetryPolicy, FailedDownload
+from .download.verify import IntegrityVerifier
 from .export_config import ExportConfig
 from .export_progress import ExportProgressInternal
 
+DOWNLOAD_QUEUE_FILE = ".texport-queue.sqlite"
+MEDIA_AUTH_CACHE_SUFFIX = ".media-auth.json"
+FAILURE_REPORT_FILE = "failed_media.json"
 
-def get_file_name(client: Client, file_id: str, mime_type: str | None, date: int | None) -> str:
+
+def get_file_name(client: Client, file_id: str, mime_type: str | None, date: int | None, message_id: str | int) -> str:
     file_id_obj = FileId.decode(file_id)
 
     file_type = file_id_obj.file_type
@@ -36,63 +45,117 @@ def get_file_name(client: Client, file_id: str, mime_type: str | None, date: int
     return (
         f"{FileType(file_id_obj.file_type).name.lower()}_"
         f"{date.strftime('%Y-%m-%d_%H-%M-%S')}_"
-        f"{client.rnd_id()}"
+        f"{message_id}"
         f"{extension}"
     )
 
+
 class MediaExporter:
     def __init__(self, client: Client, config: ExportConfig, progress: ExportProgressInternal):
         self.client = client
         self.task = None
         self.ids: set[str | int] = set()
-        self.all_ids: set[str | int] = set()
         self.progress = progress
-        self.downloaded_bytes = 0
-        self.total_bytes = 0
         self.failed_bytes = 0
 
         self._running = False
-        self._downloading: dict[str | int, ...] = {}
 
         self._loop = get_running_loop()
-        self._downloader = Downloader(client, config.max_concurrent_downloads)
-
-    async def _wait_for_dl_complete(self, task: DownloadTask, task_id: int | str) -> None:
-        await task.done.wait()
-
-        self._downloading.pop(task_id, None)
-
-        self.downloaded_bytes += task.size
-        self._status()
-
-    def add(self, file_id: str, download_dir: str, message_id: str | int, is_thumb: bool, size: int, mime: str | None, date: int | None) -> DownloadTask | None:
-        out_id = f"{message_id}_thumb" if is_thumb else message_id
-
-        if out_id in self.all_ids:
-            return self._downloading.get(out_id)
-
-        self.total_bytes += size
-
+        self._verifier = IntegrityVerifier(config.output_dir) if config.verify_media else None
+        self._cache = None
+        self._cache_executor = None
+        if config.media_cache_dir is not None:
+            self._cache = MediaCache(config.media_cache_dir, config.media_cache_limit * 1024 * 1024)
+            # Cache index is sqlite database shared with other processes, so it is used from one separate thread
+            self._cache_executor = ThreadPoolExecutor(1, thread_name_prefix="MediaCache")
+        # Download queue is kept next to exported chats, so interrupted export continues where it stopped
+        config.output_dir.mkdir(parents=True, exist_ok=True)
+        self._downloader = Downloader(
+            client,
+            max_concurrent_downloads=config.max_concurrent_downloads,
+            media_sessions_per_dc=config.media_sessions_per_dc,
+            progress_callback=self._status,
+            max_adaptive_downloads=config.max_adaptive_downloads,
+            coalesce_writes=config.coalesce_writes,
+            memory_limit=config.download_memory_limit * 1024 * 1024,
+            queue_path=config.output_dir / DOWNLOAD_QUEUE_FILE,
+            working_set=config.download_working_set,
+            auth_cache_path=self._media_auth_cache_path(client),
+            bandwidth_limit=config.bandwidth_limit * 1024,
+            dc_bandwidth_limits={dc_id: limit * 1024 for dc_id, limit in config.dc_bandwidth_limits.items()},
+            retry_policy=RetryPolicy(error_budget=config.max_download_errors),
+            task_done_callback=self._task_done,
+        )
+        self._failure_report_path = config.output_dir / FAILURE_REPORT_FILE
+
+    @staticmethod
+    def _media_auth_cache_path(client: Client) -> Path | None:
+        # Media dc auth keys are stored next to session file (~/.texport/ for cli)
+        if client.in_memory:
+            return None
+        return Path(client.workdir) / f"{client.name}{MEDIA_AUTH_CACHE_SUFFIX}"
+
+    def _task_done(self, task: DownloadTask) -> None:
+        if task.error is not None:
+            return
+        if self._verifier is not None:
+            self._verifier.submit(task.message_id, task.chat_id, task.output_path, task.size)
+        if self._cache is not None:
+            self._loop.run_in_executor(
+                self._cache_executor, self._cache.store, get_media_key(task.file_id), task.size, task.output_path,
+            )
+
+    async def add(
+            self, file_id: str, download_dir: str, message_id: str | int, is_thumb: bool, size: int, mime: str | None,
+            date: int | None, chat_id: int = 0,
+    ) -> DownloadHandle | None:
+        # Every unique media file (by media id and size) is downloaded once, other messages reference the same file
         download_dir = Path(download_dir)
         download_dir.mkdir(parents=True, exist_ok=True)
-        out_path = download_dir / get_file_name(self.client, file_id, mime, date)
+        out_path = download_dir / get_file_name(self.client, file_id, mime, date, message_id)
 
-        task = self._downloader.add_task(file_id, message_id, out_path, False, size, is_thumb)
+        # File linked from cache is complete, so downloader finishes its task without downloading anything.
+        #  Media that was already added is not looked up, other message's file is used for it.
+        from_cache = False
+        if self._cache is not None and not self._downloader.has_task(file_id) and not out_path.exists():
+            from_cache = await self._loop.run_in_executor(
+                self._cache_executor, self._cache.materialize, get_media_key(file_id), size, out_path,
+            )
 
-        self._downloading[out_id] = task
-        self.all_ids.add(out_id)
+        handle = self._downloader.add_task(file_id, message_id, out_path, False, size, is_thumb, chat_id)
+        if from_cache and handle.output_path != out_path:
+            # Same media was already added by other message, its file is used instead
+            out_path.unlink(missing_ok=True)
 
-        self._loop.create_task(self._wait_for_dl_complete(task, out_id))
+        return handle
 
-        self._status()
+    def set_chat_weight(self, chat_id: int, weight: int) -> None:
+        self._downloader.set_chat_weight(chat_id, weight)
 
-        return task
+    def set_bandwidth_limit(self, limit: int, dc_id: int | None = None) -> None:
+        self._downloader.set_bandwidth_limit(limit * 1024, dc_id)
+        self._status()
 
     def _status(self, status: str = None) -> None:
         self.progress.media_status = status or self.progress.media_status
-        self.progress.media_queue = len(self._downloader._tasks_hi) + len(self._downloader._tasks_lo)
-        self.progress.media_bytes = self.total_bytes
-        self.progress.media_down_bytes = self.downloaded_bytes
+        self.progress.media_queue = self._downloader.queue_size
+        self.progress.media_bytes = self._downloader.total_bytes
+        self.progress.media_down_bytes = self._downloader.done_bytes
+        self.progress.media_sessions = self._downloader.media_sessions_load()
+        self.progress.media_concurrency = self._downloader.concurrency_limit
+        self.progress.media_concurrency_history = self._downloader.concurrency_history
+        self.progress.media_buffered_bytes = self._downloader.buffered_bytes
+        self.progress.media_buffered_peak = self._downloader.buffered_bytes_peak
+        self.progress.media_bandwidth_limit = self._downloader.bandwidth_limit
+        self.progress.media_throttled_time = self._downloader.throttled_time
+        self.progress.media_fail_bytes = self._downloader.failed_bytes
+        self.progress.media_paused_dcs = self._downloader.paused_dcs()
+        if self._verifier is not None:
+            self.progress.media_verified = self._verifier.verified
+            self.progress.media_verify_queue = self._verifier.queue_size
+        if self._cache is not None:
+            self.progress.media_cache_hits = self._cache.hits
+            self.progress.media_cache_misses = self._cache.misses
         self.progress.changed()
 
     async def run(self) -> None:
@@ -100,8 +163,28 @@ class MediaExporter:
         self._downloader.start()
 
     async def stop(self) -> None:
-        while self._downloading:
-            await sleep(0)
-
+        # Downloader finishes all queued tasks before stopping
         await self._downloader.stop()
         self._running = False
+
+        failures = list(self._downloader.failures)
+        if self._verifier is not None:
+            self._status("Verifying downloaded media...")
+            await self._verifier.close()
+            failures.extend(self._verifier.failures)
+            self._status("Idle...")
+
+        if self._cache is not None:
+            # Files are stored in order, so all of them are in cache when it is closed
+            await self._loop.run_in_executor(self._cache_executor, self._cache.close)
+            self._cache_executor.shutdown()
+
+        await self._loop.run_in_executor(None, self._write_failure_report, failures)
+
+    def _write_failure_report(self, failures: list[FailedDownload]) -> None:
+        if not failures:
+            self._failure_report_path.unlink(missing_ok=True)
+            return
+
+        with open(self._failure_report_path, "w", encoding="utf8") as f:
+            json.dump([failure._asdict() for failure in failures], f, indent=4)
@@ -1,65 +1,115 @@
-from asyncio import sleep, get_event_loop
-from typing import Callable, Awaitable
+from __future__ import annotations
+
+from asyncio import Event, Task, get_running_loop
+from collections import deque
+from time import time
+from typing import Callable, Awaitable, AsyncIterator
 
 from pyrogram import Client
 from pyrogram.types import Message
 
-from .download.downloader import DownloadTask
+from .download.downloader import DownloadHandle
 from .export_progress import ExportProgressInternal
 from .messages_saver import MessageToSave
 
 
+class _ChatQueue:
+    __slots__ = ("messages", "finished", "error", "readable", "writable",)
+
+    def __init__(self) -> None:
+        self.messages: deque[MessageToSave] = deque()
+        self.finished = False
+        self.error: BaseException | None = None
+        # Set when there are messages (or chat is finished), waited on by consumer
+        self.readable = Event()
+        # Set when queue is below low watermark, waited on by preloading task
+        self.writable = Event()
+        self.writable.set()
+
+
 class Preloader:
     def __init__(
             self, client: Client, progress: ExportProgressInternal, chat_ids: list[int | str],
-            media_cb: Callable[[Message], Awaitable[tuple[DownloadTask | None, DownloadTask | None]]]
+            media_cb: Callable[[Message], Awaitable[tuple[DownloadHandle | None, DownloadHandle | None]]],
+            history: Callable[..., AsyncIterator[Message]] | None = None,
+            high_watermark: int = 5000, low_watermark: int = 2500,
     ):
         self.client = client
         self.progress = progress
-        self.finished = {chat_id: False for chat_id in chat_ids}
-        self.messages: dict[int | str, list[MessageToSave]] = {chat_id: [] for chat_id in chat_ids}
+        self.history = history or client.get_chat_history
+        self.queues: dict[int | str, _ChatQueue] = {chat_id: _ChatQueue() for chat_id in chat_ids}
         self.messages_loaded = 0
         self.media_cb = media_cb
-        self._chat_ids = chat_ids
-
-        self._task = None
-        self._pyro_args = ()
-        self._pyro_kwargs = {}
-        self._current_chat_id = None
-
-    def __call__(self, chat_id, *pyrogram_args, **pyrogram_kwargs):
-        self._current_chat_id = chat_id
-        self._pyro_args = pyrogram_args
-        self._pyro_kwargs = pyrogram_kwargs
-        return self
-
-    def __aiter__(self):
-        return self
-
-    async def _preload(self) -> None:
-        for chat_id in self._chat_ids:
-            async for message in self.client.get_chat_history(chat_id, *self._pyro_args, **self._pyro_kwargs):
-                tasks: tuple[DownloadTask | None, DownloadTask | None] = None, None
+        # Preloading of chat is paused when it has "high_watermark" messages waiting
+        #  and is resumed when consumer takes them down to "low_watermark"
+        self.high_watermark = max(high_watermark, 1)
+        self.low_watermark = min(max(low_watermark, 0), self.high_watermark - 1)
+
+        self._tasks: dict[int | str, Task] = {}
+
+    def __call__(self, chat_id: int | str, *pyrogram_args, **pyrogram_kwargs) -> AsyncIterator[MessageToSave]:
+        self.queues.setdefault(chat_id, _ChatQueue())
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = get_running_loop().create_task(
+                self._preload(chat_id, pyrogram_args, pyrogram_kwargs)
+            )
+        return self._iter(chat_id)
+
+    async def _put(self, queue: _ChatQueue, message: MessageToSave) -> None:
+        if len(queue.messages) >= self.high_watermark:
+            queue.writable.clear()
+            blocked_at = time()
+            await queue.writable.wait()
+            self.progress.preload_blocked_time += time() - blocked_at
+
+        queue.messages.append(message)
+        queue.readable.set()
+        self.progress.preload_queue += 1
+
+    async def _preload(self, chat_id: int | str, pyrogram_args: tuple, pyrogram_kwargs: dict) -> None:
+        queue = self.queues[chat_id]
+
+        try:
+            async for message in self.history(chat_id, *pyrogram_args, **pyrogram_kwargs):
+                tasks: tuple[DownloadHandle | None, DownloadHandle | None] = None, None
                 if message.media:
                     tasks = await self.media_cb(message)
 
-                self.messages[chat_id].append(MessageToSave(message, *tasks))
+                await self._put(queue, MessageToSave(message, *tasks))
                 self.messages_loaded += 1
 
                 self.progress.status = "Preloading messages and media..."
-                self.progress.messages_loaded = self.messages_loaded
+                self.progress.messages_loaded += 1
                 self.progress.changed()
-
-            self.finished[chat_id] = True
-
-    async def __anext__(self) -> MessageToSave:
-        if self._task is None: self._task = get_event_loop().create_task(self._preload())
-
-        while not self.finished[self._current_chat_id] and not self.messages[self._current_chat_id]:
-            await sleep(0)
-
-        if self.finished[self._current_chat_id] and not self.messages[self._current_chat_id]:
-            raise StopAsyncIteration
-
-        return self.messages[self._current_chat_id].pop(0)
-
+        except Exception as e:
+            queue.error = e
+        finally:
+            queue.finished = True
+            queue.readable.set()
+
+    async def _iter(self, chat_id: int | str) -> AsyncIterator[MessageToSave]:
+        queue = self.queues[chat_id]
+
+        try:
+            while True:
+                if not queue.messages:
+                    if queue.finished:
+                        break
+                    queue.readable.clear()
+                    await queue.readable.wait()
+                    continue
+
+                message = queue.messages.popleft()
+                self.progress.preload_queue -= 1
+                if len(queue.messages) <= self.low_watermark:
+                    queue.writable.set()
+
+                yield message
+
+            if queue.error is not None:
+                raise queue.error
+        finally:
+            if not queue.finished:
+                self._tasks[chat_id].cancel()
+            self.progress.preload_queue -= len(queue.messages)
+            queue.messages.clear()
@@ -2,11 +2,12 @@ from __future__ import annotations
 
 import asyncio
 import json
+import os
 from abc import ABC, abstractmethod
 from asyncio import get_running_loop, Task, Lock
 from collections import defaultdict
 from concurrent.futures.thread import ThreadPoolExecutor
-from os.path import exists, relpath
+from os.path import exists, relpath, getsize
 from pathlib import Path
 from typing import cast
 
@@ -18,7 +19,7 @@ from pyrogram.raw.types import User, Message as RawMessage, MessageMediaPhoto, M
     PollResults, TextWithEntities, PollAnswer, PollAnswerVoters
 from pyrogram.types import Message as PyroMessage, Chat
 
-from .download.downloader import DownloadTask
+from .download.downloader import DownloadHandle
 from .export_config import ExportConfig
 from .html.base import EXPORT_FMT_BEFORE_MESSAGES, EXPORT_AFTER_MESSAGES, Export, BaseComponent
 from .html.message import DateMessage, Message
@@ -29,7 +30,7 @@ class MessageToSave:
     __slots__ = ("message", "media_task", "thumb_task",)
 
     def __init__(
-            self, message: PyroMessage, media_task: DownloadTask | None, thumb_task: DownloadTask | None,
+            self, message: PyroMessage, media_task: DownloadHandle | None, thumb_task: DownloadHandle | None,
     ) -> None:
         self.message = message
         self.media_task = media_task
@@ -109,6 +110,8 @@ class MessageSaverBase(ABC):
         with open(path, "r+" if seek_to else "w", encoding="utf8") as f:
             f.seek(seek_to)
             f.write(append_str)
+            # File can be longer than what is written now when it is continued from saved state
+            f.truncate()
             return f.tell()
 
     async def _partial_write(self, path: str | Path, append_str: str, seek_to: int) -> int:
@@ -132,6 +135,22 @@ class MessageSaverBase(ABC):
     async def _save(self, messages: list[MessageToSave]) -> None:
         ...
 
+    def get_state(self, chat_id: int) -> dict:
+        # State that is saved after chat is exported in incremental mode, so next export can append to output
+        return {}
+
+    def load_state(self, chat_id: int, state: dict) -> bool:
+        # Returns False if output does not match state anymore, then chat is exported from scratch
+        return True
+
+    async def finish(self) -> None:
+        # Called when all messages of chat are written, before its state is saved
+        ...
+
+    def close(self) -> None:
+        # Savers are created for every exported chat, so writer threads are stopped when chat is written
+        self._write_executor.shutdown(wait=False)
+
     @staticmethod
     def register_format(format_name: str, format_cls: type[MessageSaverBase]) -> None:
         classes = MessageSaverBase._SAVER_CLASSES
@@ -163,6 +182,47 @@ class MessageSaverHtml(MessageSaverBase):
     def __init__(self, config: ExportConfig):
         super().__init__(config)
         self.parts = defaultdict(lambda: 0)
+        # Chat id -> size of every written part
+        self.part_offsets: defaultdict[int, list[int]] = defaultdict(list)
+        # Chat id -> number of parts written by previous export (in incremental mode)
+        self._old_parts: dict[int, int] = {}
+
+    def get_state(self, chat_id: int) -> dict:
+        return {"parts": self.part_offsets[chat_id]}
+
+    def load_state(self, chat_id: int, state: dict) -> bool:
+        out_dir = (self.config.output_dir / str(chat_id)).absolute()
+        offsets = state.get("parts", [])
+        for part, offset in enumerate(offsets):
+            file_path = out_dir / f"messages{part}.html"
+            if not exists(file_path) or getsize(file_path) != offset:
+                return False
+
+        # New messages are written to new parts, which are moved before existing ones when chat is written
+        self.parts[chat_id] = len(offsets)
+        self.part_offsets[chat_id] = list(offsets)
+        self._old_parts[chat_id] = len(offsets)
+        return True
+
+    def _move_new_parts_sync(self, chat_id: int, old_parts: int) -> None:
+        offsets = self.part_offsets[chat_id]
+        if not old_parts or len(offsets) == old_parts:
+            return
+
+        # History is exported newest first, so parts with new messages go before parts of previous export
+        out_dir = (self.config.output_dir / str(chat_id)).absolute()
+        order = list(range(old_parts, len(offsets))) + list(range(old_parts))
+        for part in range(len(offsets)):
+            os.replace(out_dir / f"messages{part}.html", out_dir / f"messages{part}.html.tmp")
+        for new_part, part in enumerate(order):
+            os.replace(out_dir / f"messages{part}.html.tmp", out_dir / f"messages{new_part}.html")
+
+        self.part_offsets[chat_id] = [offsets[part] for part in order]
+
+    async def finish(self) -> None:
+        for chat_id, old_parts in self._old_parts.items():
+            await self._loop.run_in_executor(self._write_executor, self._move_new_parts_sync, chat_id, old_parts)
+        self._old_parts.clear()
 
     async def _save(self, messages: list[MessageToSave]) -> None:
         if not messages:
@@ -175,8 +235,10 @@ class MessageSaverHtml(MessageSaverBase):
         if not exists(out_dir / "js") or not exists(out_dir / "images") or not exists(out_dir / "css"):
             unpack_to(out_dir)
 
-        file_path = out_dir / f"messages{self.parts[chat.id]}.html"
+        part = self.parts[chat.id]
+        file_path = out_dir / f"messages{part}.html"
         self.parts[chat.id] += 1
+        self.part_offsets[chat.id].append(0)
 
         if self.config.partial_writes:
             header = EXPORT_FMT_BEFORE_MESSAGES.format(title=_get_chat_name(chat))
@@ -225,7 +287,7 @@ class MessageSaverHtml(MessageSaverBase):
             to_write += EXPORT_AFTER_MESSAGES
 
         if to_write:
-            await self._partial_write(file_path, to_write, pos)
+            self.part_offsets[chat.id][part] = await self._partial_write(file_path, to_write, pos)
 
 
 class MessageSaverJson(MessageSaverBase):
@@ -237,11 +299,82 @@ class MessageSaverJson(MessageSaverBase):
         self._did_write_messages = False
         self._lock = Lock()
         self._pos = 0
+        # Position of first message in result.json
+        self._start = 0
+        # In incremental mode new messages are written to separate file and are inserted before messages
+        #  of previous export (start and end of them in result.json) when chat is written
+        self._file_path: Path | None = None
+        self._old_messages: tuple[int, int] | None = None
 
     async def _save(self, messages: list[MessageToSave]) -> None:
         async with self._lock:
             await self._save_real(messages)
 
+    def get_state(self, chat_id: int) -> dict:
+        if not self._init:
+            return {}
+        return {"position": self._pos, "has_messages": self._did_write_messages, "start": self._start}
+
+    def load_state(self, chat_id: int, state: dict) -> bool:
+        if "position" not in state:
+            return True
+        if "start" not in state:
+            return False
+
+        file_path = (self.config.output_dir / str(chat_id)).absolute() / "result.json"
+        if not exists(file_path) or getsize(file_path) != state["position"] + len(self._FOOTER.encode("utf8")):
+            return False
+
+        self._init = True
+        self._file_path = file_path
+        self._start = state["start"]
+        if state["has_messages"]:
+            self._old_messages = (self._start, state["position"])
+        else:
+            self._pos = state["position"]
+        return True
+
+    @staticmethod
+    def _copy_range(src, dst, length: int) -> None:
+        while length > 0:
+            data = src.read(min(length, 1024 * 1024))
+            if not data:
+                break
+            dst.write(data)
+            length -= len(data)
+
+    def _insert_new_messages_sync(self, file_path: Path, new_end: int) -> int:
+        start, end = self._old_messages
+        new_path = file_path.with_name(file_path.name + ".new")
+        tmp_path = file_path.with_name(file_path.name + ".tmp")
+
+        with open(file_path, "rb") as old_f, open(new_path, "rb") as new_f, open(tmp_path, "wb") as out_f:
+            self._copy_range(old_f, out_f, start)
+            self._copy_range(new_f, out_f, new_end)
+            out_f.write(b",\n")
+            self._copy_range(old_f, out_f, end - start)
+            pos = out_f.tell()
+            out_f.write(self._FOOTER.encode("utf8"))
+
+        os.replace(tmp_path, file_path)
+        new_path.unlink()
+        return pos
+
+    async def finish(self) -> None:
+        if self._old_messages is None:
+            return
+
+        # History is exported newest first, so new messages go before messages of previous export
+        async with self._lock:
+            if self._did_write_messages:
+                self._pos = await self._loop.run_in_executor(
+                    self._write_executor, self._insert_new_messages_sync, self._file_path, self._pos,
+                )
+            else:
+                self._pos = self._old_messages[1]
+            self._did_write_messages = True
+            self._old_messages = None
+
     async def _write_messages_json(self, file_path: str | Path, to_write: list[str]) -> None:
         if self._did_write_messages:
             to_write.insert(0, "")
@@ -261,9 +394,12 @@ class MessageSaverJson(MessageSaverBase):
 
         out_dir = (self.config.output_dir / str(chat.id)).absolute()
         file_path = out_dir / "result.json"
+        if self._old_messages is not None:
+            file_path = file_path.with_name(file_path.name + ".new")
 
         if not self._init:
             self._init = True
+            out_dir.mkdir(parents=True, exist_ok=True)
             self._pos = await self._partial_write(
                 file_path,
                 "\n".join([
@@ -276,6 +412,7 @@ class MessageSaverJson(MessageSaverBase):
                 ]),
                 0,
             )
+            self._start = self._pos
             await self._partial_write(file_path, self._FOOTER, self._pos)
 
         to_write = []
@@ -29,6 +29,21 @@ class ProgressPrinter:
 
         total_mb = prog.media_bytes / 1024 / 1024
         down_mb = prog.media_down_bytes / 1024 / 1024
+        fail_mb = prog.media_fail_bytes / 1024 / 1024
+        cache_lookups = prog.media_cache_hits + prog.media_cache_misses
+        cache_hit_rate = (prog.media_cache_hits / cache_lookups * 100) if cache_lookups else 0
+
+        sessions = ", ".join(
+            f"DC{dc_id}: {'/'.join(map(str, loads))}"
+            for dc_id, loads in sorted(prog.media_sessions.items())
+        )
+
+        chats_done = sum(1 for chat in prog.chats.values() if chat.finished)
+        chats_active = ", ".join(
+            f"{chat_id} ({chat.messages_exported}/{chat.approx_messages_count or '?'})"
+            for chat_id, chat in prog.chats.items()
+            if chat.messages_exported and not chat.finished
+        )
 
         cols, _ = shutil.get_terminal_size((80, 20))
         exp_progress = cls._progress(exported, cols, approx_count)
@@ -38,10 +53,24 @@ class ProgressPrinter:
             f"Current status: {prog.status}",
             f"Current media downloader status: {prog.media_status}",
             f"Media files in media downloader queue: {prog.media_queue}",
+            f"Media requests in flight per session: {sessions or '-'}",
+            f"Concurrent downloads limit: {prog.media_concurrency} "
+            f"(history: {' -> '.join(map(str, prog.media_concurrency_history)) or '-'})",
+            f"Media chunks in memory: {prog.media_buffered_bytes / 1024 / 1024:.2f}MB "
+            f"(peak: {prog.media_buffered_peak / 1024 / 1024:.2f}MB)",
+            f"Bandwidth limit: "
+            f"{f'{prog.media_bandwidth_limit / 1024:.0f}KB/s' if prog.media_bandwidth_limit else 'unlimited'} "
+            f"(throttled for {prog.media_throttled_time:.1f}s)",
+            f"Chats exported: {chats_done}/{len(prog.chats)} (in progress: {chats_active or '-'})",
             f"Approximate messages count: {approx_count or '?'}",
-            f"Media loaded: {down_mb:.2f}MB/{total_mb:.2f}MB",
+            f"Media loaded: {down_mb:.2f}MB/{total_mb:.2f}MB (failed: {fail_mb:.2f}MB)",
+            f"Paused DCs: {', '.join(f'DC{dc_id}' for dc_id in prog.media_paused_dcs) or '-'}",
+            f"Media files verified: {prog.media_verified} (waiting: {prog.media_verify_queue})",
+            f"Media cache hits: {prog.media_cache_hits}/{cache_lookups} ({cache_hit_rate:.1f}%)",
             media_progress,
             f"Messages loaded: {loaded if loaded else exported}",
+            f"Preloaded messages waiting to be exported: {prog.preload_queue} "
+            f"(preloading paused for {prog.preload_blocked_time:.1f}s)",
             load_progress,
             f"Messages exported: {exported}",
             exp_progress,